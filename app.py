@@ -1,8 +1,12 @@
 import streamlit as st
 import json
 import os
-import tempfile
-from processor import run_processing, strip_extension, PIANO_SOUND_DATA
+import time
+from constants import strip_extension, PIANO_SOUND_DATA, PAYLOAD_FORMATS, TICKS_PER_SECOND, DEFAULT_NOTE_CACHE_DIR
+from jobs import ConversionQueue, warm_worker
+# The pipeline (numpy, mido, scipy) is imported on the first conversion, not on page load.
+
+SOUND_FOLDER_PATH = "./sounds"
 
 st.set_page_config(
     page_title="MIDI to Bloxd Music Converter",
@@ -10,12 +14,30 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+@st.cache_resource
+def get_result_cache():
+    from cache import ResultCache
+    return ResultCache(max_bytes=int(os.environ.get("BLOXD_RESULT_CACHE_MB", "256")) * 1024 * 1024)
+
+@st.cache_resource
+def get_note_cache():
+    from cache import NoteCache
+    return NoteCache(os.environ.get("BLOXD_NOTE_CACHE_DIR", DEFAULT_NOTE_CACHE_DIR), max_bytes=int(os.environ.get("BLOXD_NOTE_CACHE_MB", "256")) * 1024 * 1024)
+
+@st.cache_resource
+def get_conversion_queue():
+    return ConversionQueue(max_workers=int(os.environ.get("BLOXD_MAX_WORKERS", "2")), initializer=warm_worker, initargs=(SOUND_FOLDER_PATH, True))
+
 if 'config_text' not in st.session_state:
     DEFAULT_CONFIG = {
         "palette": [strip_extension(s['filename']) for s in PIANO_SOUND_DATA],
         "layering": {
             "comment": "Max sounds per note. 1 = no layering. >1 = harp_pling + layers. max layer = 5",
             "max_layers": 2
+        },
+        "optimizer": {
+            "comment": "Max sounds played on one game tick (the game runs 50 tasks per tick). Extra layers are dropped quietest first. 0 = no limit",
+            "max_sounds_per_tick": 49
         }
     }
     st.session_state.config_text = json.dumps(DEFAULT_CONFIG, indent=4)
@@ -69,6 +91,21 @@ uploaded_midi = st.file_uploader(
 
 st.markdown("<h3>2. Settings</h3>", unsafe_allow_html=True)
 render_preview = st.checkbox("Generate Audio Preview", value=True, help="Creates a .wav file to simulate how the song will sound in-game.")
+preview_mode = "full"
+if render_preview:
+    preview_mode = st.radio("Preview Quality", ("draft_then_full", "draft", "full"), horizontal=True,
+                            format_func=lambda m: {"draft_then_full": "Quick draft, then full", "draft": "Quick draft only", "full": "Full quality only"}[m],
+                            help="A quick draft of the song's opening plays within seconds. \"Then full\" replaces it with the complete, full-quality preview once that is rendered.")
+preview_quality = "full" if preview_mode == "full" else "draft"
+payload_format = st.radio("Song Format", PAYLOAD_FORMATS, horizontal=True, format_func=lambda f: {"v1": "v1 (4 code blocks)", "v2": "v2 (1 compact code block)", "v3": "v3 (1 code block, tick-indexed)"}[f],
+                          help="v2 packs the whole song into one smaller code block and keeps long rests exact. v3 adds a voice table so the game plays each tick with one task. Play both with MusicPlayer.playCompactSong.")
+keyframe_seconds = 0
+if payload_format != "v1":
+    keyframe_seconds = st.number_input("Keyframe every N seconds (0 = off)", min_value=0, max_value=60, value=0,
+                                       help="Adds a keyframe index code block so MusicPlayer.playSongFrom can start the song at any time.")
+keyframe_interval = keyframe_seconds * TICKS_PER_SECOND or None
+include_reports = st.checkbox("Include note log and reports in the download", value=False, help="Adds the per-tick note log and the JSON reports to the .zip download. They take extra time to build on large songs.")
+output_profile = "full" if include_reports else "lean"
 
 with st.expander("Advanced Configuration (JSON)"):
     st.session_state.config_text = st.text_area(
@@ -87,37 +124,51 @@ if process_button:
     if uploaded_midi is None:
         st.error("Please upload a MIDI file first.", icon="🚨")
     else:
-        sound_folder_path = "./sounds"
+        sound_folder_path = SOUND_FOLDER_PATH
         if not os.path.isdir(sound_folder_path):
             st.error(f"Sound folder missing! Please create a folder named 'sounds' next to this app.", icon="🚨")
         else:
             try:
                 config_data = json.loads(st.session_state.config_text)
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mid") as tmp_midi:
-                    tmp_midi.write(uploaded_midi.getvalue())
-                    midi_path = tmp_midi.name
-
-                with st.spinner('Processing... please wait.'):
-                    output_dir = run_processing(midi_path, config_data, render_preview, sound_folder_path)
-                os.unlink(midi_path)
-
-                if output_dir:
+                from processor import convert_midi, conversion_stages
+                from cache import conversion_key
+                midi_name = os.path.splitext(uploaded_midi.name)[0]
+
+                midi_bytes = uploaded_midi.getvalue()
+                result_cache = get_result_cache()
+                cache_key = conversion_key(midi_bytes, config_data, render_preview, payload_format, "warn", keyframe_interval, preview_quality, output_profile)
+                full_preview_key = conversion_key(midi_bytes, config_data, render_preview, payload_format, "warn", keyframe_interval, "full", output_profile)
+                result = result_cache.get(full_preview_key) if preview_mode == "draft_then_full" else None
+                if result is None: result = result_cache.get(cache_key)
+                if result is None:
+                    conversion_queue = get_conversion_queue()
+                    job_id, job, job_progress = conversion_queue.submit_with_progress(convert_midi, midi_bytes, config_data, render_preview, sound_folder_path, midi_name, payload_format=payload_format, scheduler_check="warn", keyframe_interval=keyframe_interval, preview_quality=preview_quality, note_cache=get_note_cache(), output_profile=output_profile)
+                    stages = conversion_stages(render_preview, "warn", output_profile)
+                    progress_bar = st.progress(0.0, text="Starting conversion...")
+                    while True:
+                        finished = job.done()
+                        position = conversion_queue.position(job_id)
+                        if position: progress_bar.progress(0.0, text=f"Server is busy. Your conversion is number {position} in the queue.")
+                        while not job_progress.empty():
+                            event = job_progress.get_nowait()
+                            done_stages = stages.index(event["stage"]) + (event["status"] == "finished")
+                            label = f"{event['stage'].capitalize()}: {event['items']} items in {event['elapsed']:.2f}s" if event["status"] == "finished" else f"{event['stage'].capitalize()}..."
+                            progress_bar.progress(done_stages / len(stages), text=label)
+                        if finished: break
+                        time.sleep(0.2)
+                    progress_bar.empty()
+                    result = job.result()
+                    if result: result_cache.put(cache_key, result)
+
+                if result:
+                    result = dict(result, name=midi_name)  # the cache key ignores the upload's name
                     st.success("Conversion successful! Your song data is ready below.", icon="✅")
-                    output_data = {}
-                    base_name = os.path.basename(output_dir)
-                    
-                    def read_output(key, filename):
-                        path = os.path.join(output_dir, filename)
-                        if os.path.exists(path):
-                            with open(path, 'r', encoding='utf-8') as f: output_data[key] = f.read()
-                    
-                    read_output("sounds", f"1_{base_name}_sounds.txt")
-                    read_output("delays", f"2_{base_name}_delays.txt")
-                    read_output("notes", f"3_{base_name}_notes.txt")
-                    read_output("volumes", f"4_{base_name}_volumes.txt")
-                    
-                    preview_path = os.path.join(output_dir, f"8_{base_name}_preview.wav")
-                    if os.path.exists(preview_path): output_data['preview_path'] = preview_path
+                    output_data = {"payload_chunks": result["payload_chunks"], "scheduler_report": result["scheduler_report"], "result": result}
+                    if result["preview_wav"]:
+                        output_data['preview_wav'] = result["preview_wav"]
+                        output_data['preview_quality'] = result["preview_quality"]
+                        if preview_mode == "draft_then_full" and result["preview_quality"] == "draft":
+                            output_data['pending_full_preview'] = {"key": full_preview_key, "result": result}
                     st.session_state.output_data = output_data
                 else:
                     st.error("Processing finished, but no notes could be mapped.", icon="⚠️")
@@ -134,22 +185,47 @@ if st.session_state.output_data:
     st.markdown("Confused what to do now? See the [**In-Game Setup Guide**](https://github.com/NlGBOB/bloxd-piano?tab=readme-ov-file#step-6-in-game-setup) on GitHub.")
     st.info("Hover over a code block and click the icon in the top-right to copy.", icon="ℹ️")
 
-    col1, col2 = st.columns(2)
-    with col1:
-        st.write("**Sounds - Code Block 1**"); st.code(st.session_state.output_data.get("sounds", ""), language="text")
-        st.write("**Notes - Code Block 3**"); st.code(st.session_state.output_data.get("notes", ""), language="text")
-    with col2:
-        st.write("**Delays - Code Block 2**"); st.code(st.session_state.output_data.get("delays", ""), language="text")
-        st.write("**Volumes - Code Block 4**"); st.code(st.session_state.output_data.get("volumes", ""), language="text")
-
-    if 'preview_path' in st.session_state.output_data:
+    scheduler_report = st.session_state.output_data.get("scheduler_report")
+    if scheduler_report and (scheduler_report["broadcasts_dropped"] or scheduler_report["dropped_chunk_tasks"]):
+        st.warning(f"In-game playback will drop {scheduler_report['broadcasts_dropped']} notes: {scheduler_report['dropped_over_budget']} over the "
+                   f"{scheduler_report['max_tasks_per_tick']}-sounds-per-tick limit (busiest tick needs {scheduler_report['peak_tasks_per_tick']}) and "
+                   f"{scheduler_report['dropped_same_tick']} at chunk boundaries. Try fewer layers or the v2 format.", icon="⚠️")
+
+    payload_chunks = st.session_state.output_data["payload_chunks"]
+    code_blocks = [(block.capitalize() + (f" (part {j} of {len(parts)})" if len(parts) > 1 else ""), part) for block, parts in payload_chunks.items() for j, part in enumerate(parts, start=1)]
+    if len(code_blocks) > len(payload_chunks):
+        st.info("This song is longer than one code block holds, so it is split into parts. Paste each part into its own Code Block and pass them to the player "
+                "as a list, in order (see \"Long songs\" in the [setup guide](https://github.com/NlGBOB/bloxd-piano?tab=readme-ov-file#step-6-in-game-setup)).", icon="✂️")
+    columns = st.columns(min(len(code_blocks), 2))
+    for i, (label, text) in enumerate(code_blocks):
+        with columns[i % len(columns)]:
+            st.write(f"**{label} - Code Block {i + 1}**"); st.code(text, language="text")
+
+    if 'preview_wav' in st.session_state.output_data:
         st.markdown("---")
         st.markdown("<h3>Audio Preview</h3>", unsafe_allow_html=True)
-        st.caption("This is approximately how your song will sound in-game")
-        try:
-            with open(st.session_state.output_data['preview_path'], 'rb') as audio_file:
-                st.audio(audio_file.read(), format='audio/wav')
-        except Exception as e:
-            st.warning(f"Could not load audio preview: {e}")
+        caption_slot, audio_slot = st.empty(), st.empty()
+        is_draft = st.session_state.output_data.get('preview_quality') == "draft"
+        caption_slot.caption("Quick draft of the song's opening, at reduced quality" if is_draft else "This is approximately how your song will sound in-game")
+        audio_slot.audio(st.session_state.output_data['preview_wav'], format='audio/wav')
+
+        pending = st.session_state.output_data.get('pending_full_preview')
+        if pending:
+            from processor import render_preview_wav
+            with st.spinner("Rendering the full-quality preview..."):
+                _, job = get_conversion_queue().submit(render_preview_wav, pending["result"]["events"], SOUND_FOLDER_PATH)
+                full_wav = job.result()
+            del st.session_state.output_data['pending_full_preview']
+            if full_wav:
+                full_result = dict(pending["result"], preview_wav=full_wav, preview_quality="full")
+                st.session_state.output_data.update(preview_wav=full_wav, preview_quality="full", result=full_result)
+                get_result_cache().put(pending["key"], full_result)
+                caption_slot.caption("This is approximately how your song will sound in-game")
+                audio_slot.audio(full_wav, format='audio/wav')
+
+    from processor import package_outputs
+    result = st.session_state.output_data["result"]
+    st.markdown("---")
+    st.download_button("Download all files (.zip)", data=package_outputs(result), file_name=f"{result['name']}.zip", mime="application/zip", use_container_width=True)
 
 st.markdown('<div class="footer">Made by chmod</div>', unsafe_allow_html=True)
\ No newline at end of file
@@ -0,0 +1,94 @@
+import contextlib
+import copy
+import glob
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from processor import run_processing, MAX_CODE_BLOCK_CHARS
+from jobs import warm_worker
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+
+
+def is_batch_target(path):
+    return os.path.isdir(path) or any(c in path for c in "*?[")
+
+def collect_midi_files(target):
+    if os.path.isdir(target):
+        files = [os.path.join(target, name) for name in os.listdir(target) if name.lower().endswith(MIDI_EXTENSIONS)]
+    else:
+        files = [path for path in glob.glob(target, recursive=True) if path.lower().endswith(MIDI_EXTENSIONS)]
+    return sorted(files)
+
+def assign_output_dirs(midi_files, results_dir="results"):
+    """
+    Gives every file its own output folder: its path below the folder all the files share, without
+    the extension, so a/song.mid and b/song.mid go to results/a/song and results/b/song. Paths that
+    still clash (song.mid next to song.midi) get a numeric suffix. Returns {midi path: output dir}.
+    """
+    if not midi_files: return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in midi_files])
+    output_dirs, taken = {}, set()
+    for path in midi_files:
+        relative = os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0]
+        output_dir, suffix = os.path.join(results_dir, relative), 1
+        while os.path.normcase(output_dir) in taken:
+            suffix += 1
+            output_dir = os.path.join(results_dir, f"{relative}_{suffix}")
+        taken.add(os.path.normcase(output_dir))
+        output_dirs[path] = output_dir
+    return output_dirs
+
+def _convert_one(midi_path, output_dir, config, render_preview, sound_folder, payload_format="v1", scheduler_check=None, keyframe_interval=None, note_cache=None, output_profile="lean", chunk_chars=MAX_CODE_BLOCK_CHARS, preview_options=None):
+    started = time.perf_counter()
+    log = io.StringIO()
+    result = {"file": midi_path, "status": "ok", "output_dir": None, "error": None, "stages": []}
+    def record_stage(event):
+        if event["status"] == "finished": result["stages"].append({"stage": event["stage"], "items": event["items"], "seconds": round(event["elapsed"], 6)})
+    try:
+        with contextlib.redirect_stdout(log):
+            result["output_dir"] = run_processing(midi_path, copy.deepcopy(config), render_preview, sound_folder, progress=record_stage, payload_format=payload_format, scheduler_check=scheduler_check, keyframe_interval=keyframe_interval,
+                                                  note_cache=note_cache, output_profile=output_profile, chunk_chars=chunk_chars, output_dir=output_dir, **(preview_options or {}))
+        if result["output_dir"] is None: result["status"] = "empty"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+def convert_batch(midi_files, config, render_preview, sound_folder, jobs=None, payload_format="v1", scheduler_check=None, keyframe_interval=None, note_cache=None, output_profile="lean", chunk_chars=MAX_CODE_BLOCK_CHARS, preview_options=None):
+    """
+    Converts many MIDI files across a process pool. Each worker imports the pipeline and loads
+    the sound bank once, and a failing file is reported without stopping the rest of the batch.
+    Every file gets its own output folder (see assign_output_dirs). preview_options are passed on
+    to run_processing (stream_preview, mix_engine, preview_quality, preview_seconds).
+    """
+    results = []
+    output_dirs = assign_output_dirs(midi_files)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=warm_worker, initargs=(sound_folder, render_preview)) as executor:
+        futures = {executor.submit(_convert_one, path, output_dirs[path], config, render_preview, sound_folder, payload_format, scheduler_check, keyframe_interval, note_cache, output_profile, chunk_chars, preview_options): path for path in midi_files}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"file": futures[future], "status": "failed", "output_dir": None, "error": f"{type(e).__name__}: {e}", "seconds": 0.0, "stages": []}
+            results.append(result)
+            print(f"  [{len(results)}/{len(midi_files)}] {result['status']:<6} {result['seconds']:7.2f}s  {result['file']}")
+    order = {path: i for i, path in enumerate(midi_files)}
+    results.sort(key=lambda r: order[r["file"]])
+    return results
+
+def print_summary(results, wall_seconds):
+    name_width = max([len(os.path.basename(r["file"])) for r in results] + [4])
+    print(f"\n--- Batch summary ---")
+    print(f"{'File':<{name_width}}  {'Status':<6}  {'Time':>8}  Output / Error")
+    for r in results:
+        print(f"{os.path.basename(r['file']):<{name_width}}  {r['status']:<6}  {r['seconds']:7.2f}s  {r['error'] or r['output_dir'] or '-'}")
+    failed = sum(1 for r in results if r["status"] == "failed")
+    cpu_seconds = sum(r["seconds"] for r in results)
+    print(f"\n{len(results)} files, {failed} failed. Wall time {wall_seconds:.2f}s, summed per-file time {cpu_seconds:.2f}s.")
+    stems = [os.path.splitext(os.path.basename(r["file"]))[0] for r in results]
+    clashing = sorted({stem for stem in stems if stems.count(stem) > 1})
+    if clashing:
+        print(f"{sum(stems.count(stem) for stem in clashing)} files share a name with another file in the batch ({', '.join(clashing)}). Each was written to its own folder, listed above.")
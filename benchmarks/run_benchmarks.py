@@ -0,0 +1,121 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import numpy as np
+from processor import convert_midi, get_config, PAYLOAD_FORMATS
+from synthetic_midi import generate_midi
+
+# name: (tracks, chord_size, chords_per_second)
+SHAPES = {
+    "single_sparse": (1, 1, 8.0),
+    "single_dense": (1, 8, 4.0),
+    "multi_sparse": (16, 1, 8.0),
+    "multi_dense": (16, 8, 4.0),
+}
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+
+def _run_stages(midi_path, config, render_preview, sound_folder, payload_format, trace_memory):
+    stages = {}
+    def record(event):
+        if event["status"] == "started":
+            if trace_memory: tracemalloc.reset_peak()
+            return
+        stages[event["stage"]] = {"items": event["items"], "seconds": event["elapsed"]}
+        if trace_memory: stages[event["stage"]]["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+
+    if trace_memory: tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            convert_midi(midi_path, json.loads(json.dumps(config)), render_preview, sound_folder, progress=record, payload_format=payload_format)
+    finally:
+        if trace_memory: tracemalloc.stop()
+    return stages
+
+def run_case(midi_path, config, render_preview, sound_folder, payload_format, repeat):
+    """Best-of-repeat stage timings from untraced runs, plus a separate tracemalloc run for per-stage peak memory."""
+    timed_runs = [_run_stages(midi_path, config, render_preview, sound_folder, payload_format, False) for _ in range(repeat)]
+    memory_run = _run_stages(midi_path, config, render_preview, sound_folder, payload_format, True)
+    stages = {}
+    for stage in timed_runs[0]:
+        stages[stage] = {"items": timed_runs[0][stage]["items"],
+                         "seconds": min(run[stage]["seconds"] for run in timed_runs),
+                         "peak_bytes": memory_run.get(stage, {}).get("peak_bytes")}
+    return stages
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f: baseline = {r["case"]: r for r in json.load(f)["results"]}
+    print(f"\n--- Compared with '{baseline_path}' (time ratio, <1 is faster) ---")
+    for result in results:
+        before = baseline.get(result["case"])
+        if not before: continue
+        ratios = [f"{stage} {seconds['seconds'] / before['stages'][stage]['seconds']:.2f}x"
+                  for stage, seconds in result["stages"].items() if before["stages"].get(stage, {}).get("seconds")]
+        print(f"  {result['case']:<24} {'  '.join(ratios)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every conversion stage on synthetic MIDI files.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Note counts to generate.")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES), help="Track/chord layouts to generate.")
+    parser.add_argument("--config", default=None, help="Settings JSON to convert with (default: built-in defaults).")
+    parser.add_argument("--format", dest="payload_format", choices=PAYLOAD_FORMATS, default="v1", help="Payload format to encode.")
+    parser.add_argument("--render-preview", action="store_true", help="Also time the preview render (needs --sound-folder).")
+    parser.add_argument("--sound-folder", default="sounds", help="Path to the folder containing the source WAV files for rendering.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case; the fastest is kept.")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON results.")
+    parser.add_argument("--compare", default=None, help="Earlier results JSON to print per-stage time ratios against.")
+    args = parser.parse_args()
+
+    config = get_config({})
+    if args.config:
+        with open(args.config) as f: config = get_config(json.load(f))
+
+    results = []
+    with tempfile.TemporaryDirectory() as midi_dir:
+        # One untimed conversion first, so lazily imported stages and loaded sounds are not billed to the first case.
+        warmup_path = os.path.join(midi_dir, "warmup.mid")
+        generate_midi(200).save(warmup_path)
+        _run_stages(warmup_path, config, args.render_preview, args.sound_folder, args.payload_format, False)
+
+        for num_notes in args.sizes:
+            for shape in args.shapes:
+                tracks, chord_size, chords_per_second = SHAPES[shape]
+                case = f"{shape}_{num_notes}"
+                midi_path = os.path.join(midi_dir, f"{case}.mid")
+                started = time.perf_counter()
+                generate_midi(num_notes, tracks, chord_size, chords_per_second).save(midi_path)
+                print(f"--- {case}: generated in {time.perf_counter() - started:.1f}s, converting ---")
+
+                stages = run_case(midi_path, config, args.render_preview, args.sound_folder, args.payload_format, args.repeat)
+                parsed_notes = stages["parse"]["items"]
+                if parsed_notes != num_notes: print(f"  Warning: the file was generated with {num_notes} notes but {parsed_notes} were parsed.")
+                results.append({"case": case, "shape": shape, "notes": num_notes, "parsed_notes": parsed_notes, "tracks": tracks, "chord_size": chord_size,
+                                "midi_bytes": os.path.getsize(midi_path), "stages": stages,
+                                "total_seconds": sum(s["seconds"] for s in stages.values())})
+                for stage, s in stages.items():
+                    print(f"  {stage:<10} {s['items']:>9} items  {s['seconds']:8.3f}s  peak {s['peak_bytes'] / 2**20:8.1f} MB")
+
+    report = {"meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": _git_commit(), "python": platform.python_version(),
+                       "numpy": np.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                       "payload_format": args.payload_format, "render_preview": args.render_preview, "repeat": args.repeat},
+              "results": results}
+    with open(args.output, 'w') as f: json.dump(report, f, indent=4)
+    print(f"\nWrote {len(results)} results to '{args.output}'.")
+    if args.compare: compare(results, args.compare)
@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("numpy", "mido", "scipy")
+REPORT_LOADED = "import json, sys; print(json.dumps([m for m in {heavy} if m in sys.modules]))"
+
+# Snippets run in a fresh interpreter with the repo on sys.path. Anything they print last as a JSON
+# list is taken as the heavy modules that were loaded.
+APP_PAGE_LOAD = """
+import logging; logging.disable(logging.WARNING)
+from streamlit.testing.v1 import AppTest
+AppTest.from_file({app!r}, default_timeout=60).run()
+""" + REPORT_LOADED
+APP_FIRST_CONVERSION = """
+from jobs import ConversionQueue, warm_worker
+from processor import convert_midi
+queue = ConversionQueue(max_workers=1, initializer=warm_worker, initargs=({sounds!r}, True))
+with open({midi!r}, 'rb') as f: midi_bytes = f.read()
+_, job = queue.submit(convert_midi, midi_bytes, {{}}, True, {sounds!r}, "song", scheduler_check="warn", preview_quality="draft")
+assert job.result() is not None
+queue.shutdown()
+"""
+
+def build_checks(midi_path, sound_folder):
+    # name: (command, budget in seconds, heavy modules it must not load). Budgets are for a typical laptop.
+    python, cli = sys.executable, os.path.join(REPO_DIR, "midi_to_bloxd.py")
+    fill = dict(heavy=HEAVY_MODULES, app=os.path.join(REPO_DIR, "app.py"), midi=midi_path, sounds=sound_folder)
+    return {
+        "python": ([python, "-c", "pass"], 0.1, ()),
+        "cli_import": ([python, "-c", "import midi_to_bloxd; " + REPORT_LOADED.format(**fill)], 0.15, HEAVY_MODULES),
+        "cli_help": ([python, cli, "--help"], 0.2, ()),
+        "cli_convert": ([python, cli, midi_path, "--config", "config.json"], 0.8, ()),
+        "cli_convert_preview": ([python, cli, midi_path, "--config", "config.json", "--render-preview", "--sound-folder", sound_folder], 3.0, ()),
+        "app_page_load": ([python, "-c", APP_PAGE_LOAD.format(**fill)], 3.0, HEAVY_MODULES),
+        "app_first_conversion": ([python, "-c", APP_FIRST_CONVERSION.format(**fill)], 5.0, ()),
+    }
+
+def run_check(command, repeat, work_dir):
+    """Best wall time of repeat fresh runs, and the heavy modules the last run reported loading (None if it does not report)."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_DIR, os.environ.get("PYTHONPATH", "")]))
+    best, loaded = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        completed = subprocess.run(command, cwd=work_dir, env=env, capture_output=True, text=True)
+        seconds = time.perf_counter() - started
+        if completed.returncode != 0: raise RuntimeError(f"{' '.join(command[:3])} failed:\n{completed.stderr[-2000:]}")
+        best = seconds if best is None else min(best, seconds)
+        last_line = completed.stdout.strip().splitlines()[-1] if completed.stdout.strip() else ""
+        loaded = json.loads(last_line) if last_line.startswith("[") else None
+    return best, loaded
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold-start latency of the CLI and the web app, each in fresh interpreters.")
+    parser.add_argument("--midi", default=os.path.join(REPO_DIR, "midis", "gadd.mid"), help="MIDI file for the first-conversion checks.")
+    parser.add_argument("--sound-folder", default=os.path.join(REPO_DIR, "sounds"), help="Path to the folder containing the source WAV files for rendering.")
+    parser.add_argument("--checks", nargs="+", default=None, help="Only run these checks.")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh runs per check; the fastest is kept.")
+    parser.add_argument("--budget-scale", type=float, default=1.0, help="Multiply every budget, e.g. 2 on a slow CI machine.")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    checks = build_checks(os.path.abspath(args.midi), os.path.abspath(args.sound_folder))
+    results, failed = [], False
+    print(f"--- Startup check (best of {args.repeat} fresh runs) ---")
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in args.checks or checks:
+            command, budget, must_not_load = checks[name]
+            seconds, loaded = run_check(command, args.repeat, work_dir)
+            budget *= args.budget_scale
+            problems = ([f"over the {budget:.2f}s budget"] if seconds > budget else []) + [f"loads {m}" for m in must_not_load if loaded and m in loaded]
+            failed |= bool(problems)
+            results.append({"check": name, "seconds": seconds, "budget_seconds": budget, "heavy_modules_loaded": loaded, "problems": problems})
+            print(f"  {name:<22} {seconds:7.3f}s  (budget {budget:5.2f}s)  {'FAIL: ' + ', '.join(problems) if problems else 'ok'}")
+
+    if args.output:
+        with open(args.output, 'w') as f: json.dump({"python": sys.version.split()[0], "results": results}, f, indent=4)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,56 @@
+import numpy as np
+import mido
+
+TICKS_PER_BEAT = 480
+TEMPO = 500000
+MIDI_TICKS_PER_SECOND = TICKS_PER_BEAT * 1e6 / TEMPO
+
+
+PIANO_KEYS = 88
+LOWEST_KEY = 21
+CHORDS_PER_BLOCK = 100000
+
+
+def _chord_keys(rng, num_chords, chord_size):
+    # chord_size distinct keys per chord: the first chord_size columns of a random permutation of the 88 keys.
+    if chord_size == 1: return rng.integers(0, PIANO_KEYS, num_chords)[:, None]
+    blocks = [np.argsort(rng.random((min(CHORDS_PER_BLOCK, num_chords - i), PIANO_KEYS), dtype=np.float32), axis=1)[:, :chord_size]
+              for i in range(0, num_chords, CHORDS_PER_BLOCK)]
+    return np.concatenate(blocks) if blocks else np.zeros((0, chord_size), dtype=np.int64)
+
+def generate_midi(num_notes, tracks=1, chord_size=1, chords_per_second=8.0, seed=0):
+    """
+    Builds a type 1 MIDI file with num_notes notes: chords of chord_size distinct random keys started
+    chords_per_second times a second, dealt round-robin across tracks. Pitches, velocities
+    and lengths (0.1-1.0s) are random but fixed by seed, so every run benchmarks the same file.
+    A note is cut short where the same key starts again on its channel, so every note parses back.
+    """
+    if not 1 <= chord_size <= PIANO_KEYS: raise ValueError(f"chord_size must be between 1 and {PIANO_KEYS}.")
+    rng = np.random.default_rng(seed)
+    chord_of_note = np.arange(num_notes) // chord_size
+    start = np.round(chord_of_note / chords_per_second * MIDI_TICKS_PER_SECOND).astype(np.int64)
+    end = start + np.round(rng.uniform(0.1, 1.0, num_notes) * MIDI_TICKS_PER_SECOND).astype(np.int64)
+    notes = LOWEST_KEY + _chord_keys(rng, -(-num_notes // chord_size), chord_size).ravel()[:num_notes]
+    velocities = rng.integers(40, 121, num_notes)
+    track_of_note = chord_of_note % tracks
+
+    # End each note no later than the next note of the same key on the same channel starts.
+    channel_of_note = track_of_note % 16
+    order = np.lexsort((start, notes, channel_of_note))
+    same_key_next = (notes[order][1:] == notes[order][:-1]) & (channel_of_note[order][1:] == channel_of_note[order][:-1])
+    end[order[:-1][same_key_next]] = np.minimum(end[order[:-1][same_key_next]], start[order[1:][same_key_next]])
+
+    mid = mido.MidiFile(type=1, ticks_per_beat=TICKS_PER_BEAT)
+    for track_index in range(tracks):
+        track = mido.MidiTrack()
+        if track_index == 0: track.append(mido.MetaMessage('set_tempo', tempo=TEMPO, time=0))
+        ids = np.flatnonzero(track_of_note == track_index)
+        times = np.concatenate((start[ids], end[ids]))
+        is_on = np.concatenate((np.ones(len(ids), dtype=bool), np.zeros(len(ids), dtype=bool)))
+        order = np.lexsort((is_on, times))
+        deltas = np.diff(times[order], prepend=0)
+        channel = track_index % 16
+        for delta, on, note, velocity in zip(deltas.tolist(), is_on[order].tolist(), np.tile(notes[ids], 2)[order].tolist(), np.tile(velocities[ids], 2)[order].tolist()):
+            track.append(mido.Message('note_on' if on else 'note_off', channel=channel, note=note, velocity=velocity if on else 0, time=delta))
+        mid.tracks.append(track)
+    return mid
@@ -0,0 +1,112 @@
+import glob
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+import numpy as np
+from processor import normalize_config, NOTE_DTYPE
+from constants import DEFAULT_NOTE_CACHE_DIR, MAX_CODE_BLOCK_CHARS
+
+
+def conversion_key(midi_bytes, config_data, render_preview, payload_format="v1", scheduler_check=None, keyframe_interval=None, preview_quality="full", output_profile="full", chunk_chars=MAX_CODE_BLOCK_CHARS):
+    digest = hashlib.sha256(midi_bytes)
+    digest.update(json.dumps([normalize_config(config_data), bool(render_preview), payload_format, scheduler_check, keyframe_interval, preview_quality if render_preview else None, output_profile, chunk_chars], sort_keys=True).encode())
+    return digest.hexdigest()
+
+def estimate_result_bytes(result):
+    total = 0
+    for value in result.values():
+        if isinstance(value, dict): total += estimate_result_bytes(value)
+        elif isinstance(value, np.ndarray): total += value.nbytes
+        elif isinstance(value, (str, bytes)): total += sys.getsizeof(value)
+        elif isinstance(value, list): total += sum(sys.getsizeof(item) for item in value if isinstance(item, (str, bytes)))
+    return total
+
+
+class ResultCache:
+    """
+    Thread-safe LRU of conversion results keyed by conversion_key, bounded by an estimate
+    of the bytes it holds. One instance is shared by every session of the web app.
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        size = estimate_result_bytes(result)
+        if size > self.max_bytes: return
+        with self._lock:
+            if key in self.entries: self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (result, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+
+class NoteCache:
+    """
+    On-disk cache of parsed note arrays (NOTE_DTYPE) as .npy files named by the MIDI's sha256,
+    so a reconversion with a new config skips parsing. Files are written atomically, so worker
+    processes can share one folder. When the folder grows past max_bytes, the least recently
+    used files are deleted. Bump FORMAT_VERSION whenever parsing changes its output.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, cache_dir=DEFAULT_NOTE_CACHE_DIR, max_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _path(self, midi_bytes):
+        return os.path.join(self.cache_dir, f"{hashlib.sha256(midi_bytes).hexdigest()}_v{self.FORMAT_VERSION}.npy")
+
+    def get(self, midi_bytes):
+        path = self._path(midi_bytes)
+        try:
+            parsed_notes = np.load(path, allow_pickle=False)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return parsed_notes if parsed_notes.dtype == NOTE_DTYPE else None
+
+    def put(self, midi_bytes, parsed_notes):
+        if parsed_notes.nbytes > self.max_bytes: return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(midi_bytes)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f: np.save(f, parsed_notes)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.npy")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
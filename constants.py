@@ -0,0 +1,36 @@
+import os
+
+# Plain-Python constants shared by the pipeline, the CLI and the web app. This module must stay
+# free of numpy/mido/scipy so entry points can build their UI and argument parsers without them.
+PIANO_HZ = (27.50, 29.14, 30.87, 32.70, 34.65, 36.71, 38.89, 41.20, 43.65, 46.25, 49.00, 51.91, 55.00, 58.27, 61.74, 65.41, 69.30, 73.42, 77.78, 82.41, 87.31, 92.50, 98.00, 103.83, 110.00, 116.54, 123.47, 130.81, 138.59, 146.83, 155.56, 164.81, 174.61, 185.00, 196.00, 207.65, 220.00, 233.08, 246.94, 261.63, 277.18, 293.66, 311.13, 329.63, 349.23, 369.99, 392.00, 415.30, 440.00, 466.16, 493.88, 523.25, 554.37, 587.33, 622.25, 659.26, 698.46, 739.99, 783.99, 830.61, 880.00, 932.33, 987.77, 1046.50, 1108.73, 1174.66, 1244.51, 1318.51, 1396.91, 1479.98, 1567.98, 1661.22, 1760.00, 1864.66, 1975.53, 2093.00, 2217.46, 2349.32, 2489.02, 2637.02, 2793.83, 2959.96, 3135.96, 3322.44, 3520.00, 3729.31, 3951.07, 4186.01)
+NOTE_INDEX_TO_CHAR_MAP = "⁰¹²³⁴⁵⁶⁷⁸⁹ᵃᵇᶜᵈᵉᶠᵍʰⁱʲᵏˡᵐᶰⁿᵒᵖʳˢᵗᵘᵛʷˣʸᶻʱʴʵʶ₀₁₂₃₄₅₆₇₈₉ₐₑₒₓₔₕᵢⱼᵣᵤᵥₖₗₘₙₚₛₜ​‌‍⁠⁡⁢⁣⁤⁧⁩⁨⁪⁫⁬⁭⁮⁯﻿︀︁︂︃︄︅︆︇︈︉︊︋︌︍"
+
+if len(PIANO_HZ) > len(NOTE_INDEX_TO_CHAR_MAP): raise ValueError("NOTE_INDEX_TO_CHAR_MAP is not long enough for 88 keys/delays.")
+
+GAME_SOUND_PALETTE = ["harp_pling.wav", "game_start_countdown_01.wav", "game_start_countdown_02.wav", "game_start_countdown_03.wav", "game_start_countdown_final.wav"]
+SOUND_TO_INDEX = {sound: i for i, sound in enumerate(GAME_SOUND_PALETTE)}
+TICKS_PER_SECOND = 20
+PIANO_SOUND_DATA = [
+    {"filename": "harp_pling.wav", "base_pitch_hz": 260.79, "base_duration_sec": 0.84},
+    {"filename": "game_start_countdown_01.wav", "base_pitch_hz": 329.75, "base_duration_sec": 1.0},
+    {"filename": "game_start_countdown_02.wav", "base_pitch_hz": 164.84, "base_duration_sec": 0.99},
+    {"filename": "game_start_countdown_03.wav", "base_pitch_hz": 164.87, "base_duration_sec": 1.0},
+    {"filename": "game_start_countdown_final.wav", "base_pitch_hz": 658.83, "base_duration_sec": 1.58},
+]
+MAX_DELAY_TICKS = 87
+PRIMARY_SOUND_NAME = "harp_pling.wav"
+LAYER_SOUND_NAMES = [s['filename'] for s in PIANO_SOUND_DATA if s['filename'] != PRIMARY_SOUND_NAME]
+
+def strip_extension(name):
+    return name[:-4] if isinstance(name, str) and name.lower().endswith('.wav') else name
+
+SOUND_NAMES = [strip_extension(s) for s in GAME_SOUND_PALETTE]
+
+PAYLOAD_FORMATS = ("v1", "v2", "v3")
+SCHEDULER_CHECKS = ("warn", "fail")
+MIX_ENGINES = ("auto", "events", "convolution")
+PREVIEW_QUALITIES = ("full", "draft")
+OUTPUT_PROFILES = ("full", "lean")
+# The most characters one in-game code block holds; longer payloads are split into several blocks.
+MAX_CODE_BLOCK_CHARS = 16000
+DEFAULT_NOTE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bloxd-piano", "notes")
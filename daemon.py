@@ -0,0 +1,214 @@
+import argparse
+import base64
+import json
+import os
+import signal
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from constants import PAYLOAD_FORMATS, SCHEDULER_CHECKS, PREVIEW_QUALITIES, OUTPUT_PROFILES, MAX_CODE_BLOCK_CHARS, DEFAULT_NOTE_CACHE_DIR
+
+RESPONSE_FIELDS = ("name", "payload_format", "payload", "payload_chunks", "output_profile", "optimizer_report", "scheduler_report", "sounds_used", "mapping_report", "note_log", "preview_quality", "timings")
+
+def _flag(value):
+    return value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes", "on")
+
+def _file_name(value):
+    return "".join(c for c in str(value) if c.isalnum() or c in " ._-").strip(" .") or "song"
+
+def _optional_int(value):
+    return None if value in (None, "", "null") else int(value)
+
+# Request option: (parser, default, allowed values or None). Options come from the JSON body or the query string.
+REQUEST_OPTIONS = {
+    "name": (_file_name, "song", None),
+    "render_preview": (_flag, False, None),
+    "preview_quality": (str, "full", PREVIEW_QUALITIES),
+    "payload_format": (str, "v1", PAYLOAD_FORMATS),
+    "keyframe_interval": (_optional_int, None, None),
+    "scheduler_check": (lambda value: value or None, None, (None,) + SCHEDULER_CHECKS),
+    "output_profile": (str, "lean", OUTPUT_PROFILES),
+    "chunk_chars": (int, MAX_CODE_BLOCK_CHARS, None),
+    "output": (str, "json", ("json", "zip")),
+}
+
+def parse_options(values):
+    unknown = set(values) - set(REQUEST_OPTIONS)
+    if unknown: raise ValueError(f"Unknown options: {', '.join(sorted(unknown))}.")
+    options = {}
+    for option, (parse, default, allowed) in REQUEST_OPTIONS.items():
+        options[option] = parse(values[option]) if option in values else default
+        if allowed is not None and options[option] not in allowed: raise ValueError(f"{option} must be one of {', '.join(str(a) for a in allowed)}.")
+    if options["keyframe_interval"] is not None and (options["keyframe_interval"] <= 0 or options["payload_format"] == "v1"):
+        raise ValueError("keyframe_interval needs a positive tick interval and payload_format v2 or v3.")
+    if options["chunk_chars"] < 0: raise ValueError("chunk_chars cannot be negative.")
+    return options
+
+
+class ConversionDaemon:
+    """
+    Serves conversions from a ConversionQueue of resident worker processes. Each worker imports the
+    pipeline and loads the sound bank once, and keeps its pitched buffers between requests, so a
+    request only pays for its own conversion. Finished results are kept in a ResultCache.
+    """
+    def __init__(self, sound_folder, config, workers=None, note_cache=None, result_cache_bytes=256 * 1024 * 1024, max_upload_bytes=32 * 1024 * 1024):
+        from jobs import ConversionQueue, warm_worker
+        from cache import ResultCache
+        self.sound_folder = sound_folder
+        self.config = config
+        self.note_cache = note_cache
+        self.max_upload_bytes = max_upload_bytes
+        self.queue = ConversionQueue(max_workers=workers, initializer=warm_worker, initargs=(sound_folder, True))
+        self.result_cache = ResultCache(max_bytes=result_cache_bytes)
+
+    def warm(self):
+        """Starts every worker now instead of on its first request. Returns the worker process ids."""
+        jobs = [self.queue.submit(os.getpid)[1] for _ in range(self.queue.max_workers)]
+        return sorted({job.result() for job in jobs})
+
+    def status(self):
+        cache = self.result_cache
+        return {"status": "ok", "workers": self.queue.max_workers, "waiting": self.queue.waiting(),
+                "result_cache": {"entries": len(cache.entries), "bytes": cache.total_bytes, "hits": cache.hits, "misses": cache.misses}}
+
+    def convert(self, midi_bytes, config_data, options):
+        """Returns (HTTP status, content type, body bytes) for one conversion request."""
+        from cache import conversion_key
+        from jobs import convert_quietly
+        from processor import get_config, package_outputs, MidiFormatError
+        from scheduler_sim import SchedulerBudgetError
+        started = time.perf_counter()
+        config = get_config(json.loads(json.dumps(self.config if config_data is None else config_data)))
+        o = options
+        key = conversion_key(midi_bytes, config, o["render_preview"], o["payload_format"], o["scheduler_check"], o["keyframe_interval"], o["preview_quality"], o["output_profile"], o["chunk_chars"])
+        result = self.result_cache.get(key)
+        cached = result is not None
+        if result is None:
+            _, job = self.queue.submit(convert_quietly, midi_bytes, config, o["render_preview"], self.sound_folder, o["name"], payload_format=o["payload_format"], scheduler_check=o["scheduler_check"],
+                                       keyframe_interval=o["keyframe_interval"], preview_quality=o["preview_quality"], note_cache=self.note_cache, output_profile=o["output_profile"], chunk_chars=o["chunk_chars"])
+            try:
+                result = job.result()
+            except MidiFormatError as e:
+                return 400, "application/json", _json({"error": str(e)})
+            except SchedulerBudgetError as e:
+                return 422, "application/json", _json({"error": f"Scheduler check failed. {e}"})
+            except Exception as e:
+                return 500, "application/json", _json({"error": f"{type(e).__name__}: {e}"})
+            if result is None: return 422, "application/json", _json({"error": "No notes could be mapped."})
+            self.result_cache.put(key, result)
+        result = dict(result, name=o["name"])
+
+        if o["output"] == "zip": return 200, "application/zip", package_outputs(result)
+        response = {field: result.get(field) for field in RESPONSE_FIELDS}
+        response["preview_wav"] = base64.b64encode(result["preview_wav"]).decode("ascii") if result["preview_wav"] else None
+        response["cached"] = cached
+        response["seconds"] = time.perf_counter() - started
+        return 200, "application/json", _json(response)
+
+def _json(value):
+    return json.dumps(value).encode("utf-8")
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """
+    GET /health reports the workers, queue and result cache.
+    POST /convert takes either raw MIDI bytes with options in the query string (?payload_format=v2&render_preview=1),
+    or a JSON body {"midi": <base64>, "config": {...}, <options>}. The response is JSON, or a .zip of
+    the output files with output=zip.
+    """
+    server_version = "BloxdPianoDaemon/1.0"
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix-socket"
+
+    def _send(self, status, content_type, body, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers: self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health": return self._send(404, "application/json", _json({"error": "Use GET /health or POST /convert."}))
+        self._send(200, "application/json", _json(self.server.conversion_daemon.status()))
+
+    def do_POST(self):
+        daemon = self.server.conversion_daemon
+        url = urlparse(self.path)
+        if url.path != "/convert": return self._send(404, "application/json", _json({"error": "Use GET /health or POST /convert."}))
+        length = self.headers.get("Content-Length") or "0"
+        if not length.isdigit(): return self._send(400, "application/json", _json({"error": "Content-Length must be a non-negative whole number."}))
+        length = int(length)
+        if length > daemon.max_upload_bytes: return self._send(413, "application/json", _json({"error": f"Uploads are limited to {daemon.max_upload_bytes} bytes."}))
+        body = self.rfile.read(length)
+        try:
+            if self.headers.get_content_type() == "application/json":
+                request = json.loads(body)
+                if not isinstance(request, dict): raise ValueError("The JSON body must be an object.")
+                midi_bytes, config_data = base64.b64decode(request.pop("midi", ""), validate=True), request.pop("config", None)
+                if config_data is not None and not (isinstance(config_data, dict) and isinstance(config_data.get("palette", []), list) and all(isinstance(config_data.get(k, {}), dict) for k in ("layering", "optimizer"))):
+                    raise ValueError('config must be a JSON object shaped like config.json ("palette" a list, "layering" and "optimizer" objects).')
+            else:
+                request = {option: values[-1] for option, values in parse_qs(url.query).items()}
+                midi_bytes, config_data = body, None
+            if not midi_bytes: raise ValueError("The request has no MIDI data.")
+            options = parse_options(request)
+        except (ValueError, TypeError) as e:
+            return self._send(400, "application/json", _json({"error": str(e)}))
+        try:
+            status, content_type, response = daemon.convert(midi_bytes, config_data, options)
+        except Exception as e:
+            status, content_type, response = 500, "application/json", _json({"error": f"{type(e).__name__}: {e}"})
+        headers = [("Content-Disposition", f'attachment; filename="{options["name"]}.zip"')] if content_type == "application/zip" else []
+        self._send(status, content_type, response, headers)
+
+
+def _stop_on_signal(signum, frame):
+    raise KeyboardInterrupt  # `kill` shuts down the same way as Ctrl+C
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a resident conversion server on localhost (or a Unix socket) with warm workers and caches.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on. Keep the default unless the server is behind something that controls access.")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port to listen on.")
+    parser.add_argument("--socket", default=None, metavar="PATH", help="Listen on this Unix socket instead of a TCP port.")
+    parser.add_argument("--workers", type=int, default=None, help="Conversions that run at once, each in its own worker process (default: CPU count).")
+    parser.add_argument("--config", default="config.json", help="Settings JSON used when a request does not send its own config.")
+    parser.add_argument("--sound-folder", default="sounds", help="Path to the folder containing the source WAV files for rendering.")
+    parser.add_argument("--note-cache", nargs="?", const=DEFAULT_NOTE_CACHE_DIR, default=None, metavar="DIR", help=f"Keep parsed notes on disk across requests and restarts. DIR defaults to {DEFAULT_NOTE_CACHE_DIR}.")
+    parser.add_argument("--result-cache-mb", type=int, default=256, help="Memory for finished results, so a repeated request is answered without converting.")
+    parser.add_argument("--max-upload-mb", type=int, default=32, help="Largest request body accepted.")
+    args = parser.parse_args()
+
+    from midi_to_bloxd import load_config
+    from cache import NoteCache
+    config = load_config(args.config)
+    daemon = ConversionDaemon(args.sound_folder, config, args.workers, NoteCache(args.note_cache) if args.note_cache else None,
+                              args.result_cache_mb * 1024 * 1024, args.max_upload_mb * 1024 * 1024)
+    print(f"--- Starting {daemon.queue.max_workers} workers ---")
+    started = time.perf_counter()
+    pids = daemon.warm()
+    print(f"{len(pids)} workers ready in {time.perf_counter() - started:.2f}s.")
+
+    if args.socket:
+        if os.path.exists(args.socket): os.remove(args.socket)
+        server, address = ThreadingUnixHTTPServer(args.socket, ConversionHandler), args.socket
+    else:
+        server, address = ThreadingHTTPServer((args.host, args.port), ConversionHandler), f"http://{args.host}:{args.port}"
+    server.conversion_daemon = daemon
+    signal.signal(signal.SIGTERM, _stop_on_signal)
+    print(f"--- Serving on {address}: POST /convert, GET /health. Press Ctrl+C to stop. ---")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n--- Shutting down ---")
+    finally:
+        server.server_close()
+        daemon.queue.shutdown()
+        if args.socket and os.path.exists(args.socket): os.remove(args.socket)
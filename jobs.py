@@ -0,0 +1,115 @@
+import contextlib
+import io
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import types
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from constants import GAME_SOUND_PALETTE
+
+
+def warm_worker(sound_folder, render_preview):
+    import processor  # so the first job does not pay for importing the pipeline
+    if render_preview:
+        from renderer import SoundBank
+        with contextlib.redirect_stdout(io.StringIO()): SoundBank.shared(sound_folder).load(GAME_SOUND_PALETTE)
+
+def convert_quietly(*args, **kwargs):
+    """convert_midi with its console log discarded and without the event array, for callers that only send the encoded output on."""
+    from processor import convert_midi
+    with contextlib.redirect_stdout(io.StringIO()): result = convert_midi(*args, **kwargs)
+    if result is not None: del result["events"]
+    return result
+
+def _call_with_progress(fn, progress_queue, args, kwargs):
+    return fn(*args, progress=progress_queue.put, **kwargs)
+
+_MAIN_MODULE_LOCK = threading.Lock()
+
+@contextlib.contextmanager
+def _neutral_main_module():
+    # spawn re-imports __main__ in each new worker; under `streamlit run` that would be the app script.
+    # The swap is process-wide, so threads starting workers at the same time take turns.
+    with _MAIN_MODULE_LOCK:
+        main_module = sys.modules.get('__main__')
+        sys.modules['__main__'] = types.ModuleType('__main__')
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = main_module
+
+
+class ConversionQueue:
+    """
+    Runs conversion jobs on a bounded set of worker processes. At most max_workers jobs run
+    at once; the rest wait in FIFO order and position() reports their place in line.
+    Every slot owns a single-process pool, so a worker that crashes only fails its own job
+    and the slot is given a fresh process for the next one.
+    """
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._initializer = initializer
+        self._initargs = initargs
+        self._dispatchers = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="conversion-slot")
+        self._slot = threading.local()
+        self._pools = []
+        self._manager = None
+        self._waiting = []
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _slot_pool(self):
+        pool = getattr(self._slot, 'pool', None)
+        if pool is None:
+            # spawn, not fork: the web server has live threads that must not be copied into workers.
+            pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=self._initializer, initargs=self._initargs)
+            self._slot.pool = pool
+            with self._lock: self._pools.append(pool)
+        return pool
+
+    def submit(self, fn, *args, **kwargs):
+        job_id = next(self._job_ids)
+        with self._lock: self._waiting.append(job_id)
+        return job_id, self._dispatchers.submit(self._dispatch, job_id, fn, args, kwargs)
+
+    def submit_with_progress(self, fn, *args, **kwargs):
+        """
+        Like submit, but fn is also given progress=<callback> and the stage events it reports
+        are returned through a queue the caller can poll while the job runs.
+        """
+        with self._lock:
+            if self._manager is None:
+                with _neutral_main_module(): self._manager = multiprocessing.get_context("spawn").Manager()
+            progress_queue = self._manager.Queue()
+        job_id, future = self.submit(_call_with_progress, fn, progress_queue, args, kwargs)
+        return job_id, future, progress_queue
+
+    def _dispatch(self, job_id, fn, args, kwargs):
+        with self._lock: self._waiting.remove(job_id)
+        pool = self._slot_pool()
+        try:
+            with _neutral_main_module():
+                future = pool.submit(fn, *args, **kwargs)
+            return future.result()
+        except BrokenProcessPool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self._slot.pool = None
+            with self._lock: self._pools.remove(pool)
+            raise
+
+    def position(self, job_id):
+        with self._lock:
+            return self._waiting.index(job_id) + 1 if job_id in self._waiting else 0
+
+    def waiting(self):
+        with self._lock: return len(self._waiting)
+
+    def shutdown(self):
+        self._dispatchers.shutdown(wait=True)
+        with self._lock: pools, self._pools = self._pools, []
+        for pool in pools: pool.shutdown(wait=True)
+        if self._manager is not None: self._manager.shutdown()
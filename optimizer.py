@@ -0,0 +1,63 @@
+import numpy as np
+from processor import SOUND_NAMES, SOUND_TO_INDEX, PRIMARY_SOUND_NAME, VOLUME_LEVELS, sort_and_compute_delays
+
+# The in-game scheduler runs 50 tasks per tick and the player's own chunk task takes one of them.
+DEFAULT_MAX_SOUNDS_PER_TICK = 49
+PRIMARY_SOUND_INDEX = SOUND_TO_INDEX[PRIMARY_SOUND_NAME]
+
+
+def _first_in_group(*keys):
+    starts = np.ones(len(keys[0]), dtype=bool)
+    if len(starts): starts[1:] = np.any([k[1:] != k[:-1] for k in keys], axis=0)
+    return starts
+
+def audibility(game_events):
+    return game_events['velocity'] / 127.0 * VOLUME_LEVELS[game_events['volume_index']]
+
+def optimize_events(game_events, optimizer_config):
+    """
+    Trims tick-sorted game events before encoding. Events that repeat the same sound and note
+    on the same tick are merged into the loudest one. Ticks with more than max_sounds_per_tick
+    events then drop the least audible (velocity x volume) first, layers before harp_pling
+    primaries. Returns the kept events, delays recomputed, and a report of what was removed.
+    """
+    budget = optimizer_config.get("max_sounds_per_tick", DEFAULT_MAX_SOUNDS_PER_TICK)
+    keep = np.ones(len(game_events), dtype=bool)
+
+    order = np.lexsort((game_events['volume_index'], game_events['note_index'], game_events['sound_index'], game_events['tick']))
+    ordered = game_events[order]
+    keep[order] = _first_in_group(ordered['tick'], ordered['sound_index'], ordered['note_index'])
+    duplicates_removed = int((~keep).sum())
+
+    over_budget = np.zeros(len(game_events), dtype=bool)
+    if budget:
+        candidates = np.flatnonzero(keep)
+        events = game_events[candidates]
+        is_layer = events['sound_index'] != PRIMARY_SOUND_INDEX
+        order = np.lexsort((-audibility(events), is_layer, events['tick']))
+        group_starts = np.flatnonzero(_first_in_group(events['tick'][order]))
+        group_sizes = np.diff(np.append(group_starts, len(order)))
+        rank = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+        over_budget[candidates[order[rank >= budget]]] = True
+        keep &= ~over_budget
+
+    removed = game_events[over_budget]
+    counts = np.bincount(removed['sound_index'], minlength=len(SOUND_NAMES))
+    report = {
+        "max_sounds_per_tick": budget,
+        "events_in": len(game_events),
+        "events_out": int(keep.sum()),
+        "duplicates_removed": duplicates_removed,
+        "over_budget_removed": int(over_budget.sum()),
+        "primary_removed": int((removed['sound_index'] == PRIMARY_SOUND_INDEX).sum()),
+        "ticks_over_budget": int(len(np.unique(removed['tick']))),
+        "over_budget_removed_by_sound": {SOUND_NAMES[i]: int(c) for i, c in enumerate(counts.tolist()) if c},
+    }
+    return sort_and_compute_delays(game_events[keep]), report
+
+def format_optimizer_report(report):
+    lines = [f"Optimizer: {report['events_in']} -> {report['events_out']} events. "
+             f"Merged {report['duplicates_removed']} duplicate sounds, dropped {report['over_budget_removed']} over the {report['max_sounds_per_tick']}-sounds-per-tick budget on {report['ticks_over_budget']} ticks."]
+    if report["primary_removed"]:
+        lines.append(f"    WARNING: {report['primary_removed']} harp_pling notes were dropped; those ticks have more notes than the budget even without layers.")
+    return "\n".join(lines)
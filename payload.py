@@ -0,0 +1,179 @@
+import numpy as np
+from processor import GAME_SOUND_PALETTE, EVENT_DTYPE, VOLUME_LEVELS, PIANO_HZ
+
+# v2 packs a whole song into one code block. Every character is either
+#   an event symbol:  EVENT_SYMBOL_BASE + (sound_index * 5 + volume_index) * 88 + note_index
+#   a delay symbol:   DELAY_SYMBOL_BASE + ticks - 1, advancing the clock by 1..MAX_DELAY_SYMBOL_TICKS
+# Events with no delay symbol between them share a tick, so chords cost nothing extra. Delay
+# symbols add up, so rests of any length are exact: a rest longer than MAX_DELAY_SYMBOL_TICKS
+# is written as several delay symbols. Both ranges are contiguous CJK blocks in the BMP, so
+# every symbol is a single UTF-16 unit in game.
+# v3 uses the same stream, but its event symbols index a voice table at the start of the song,
+# so the in-game player can walk the song one tick group at a time with everything precomputed.
+PAYLOAD_V2_HEADER = "v2"
+PAYLOAD_V3_HEADER = "v3"
+VOICE_TABLE_END = ":"
+EVENT_SYMBOL_BASE = 0x4E00
+DELAY_SYMBOL_BASE = 0x3400
+MAX_DELAY_SYMBOL_TICKS = 0x4DBF - DELAY_SYMBOL_BASE + 1
+NUM_NOTE_SYMBOLS = len(PIANO_HZ)
+NUM_VOLUME_LEVELS = len(VOLUME_LEVELS)
+
+
+def event_symbols(game_events):
+    sound_volume = game_events['sound_index'].astype(np.int64) * NUM_VOLUME_LEVELS + game_events['volume_index']
+    return EVENT_SYMBOL_BASE + sound_volume * NUM_NOTE_SYMBOLS + game_events['note_index']
+
+def _codes_to_str(codes):
+    return np.asarray(codes, dtype='<u4').tobytes().decode('utf-32-le')
+
+def _str_to_codes(text):
+    return np.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(np.int64)
+
+def _encode_stream(ticks, symbols):
+    # Interleaves event symbols with the delay symbols that advance the clock to each event's tick.
+    delays = np.diff(ticks, prepend=0)
+    delay_symbol_counts = -(-delays // MAX_DELAY_SYMBOL_TICKS)
+    event_positions = np.arange(len(ticks)) + np.cumsum(delay_symbol_counts)
+
+    codes = np.full(len(ticks) + int(delay_symbol_counts.sum()), DELAY_SYMBOL_BASE + MAX_DELAY_SYMBOL_TICKS - 1, dtype=np.int64)
+    codes[event_positions] = symbols
+    has_delay = delay_symbol_counts > 0
+    remainders = delays[has_delay] - (delay_symbol_counts[has_delay] - 1) * MAX_DELAY_SYMBOL_TICKS
+    codes[event_positions[has_delay] - 1] = DELAY_SYMBOL_BASE + remainders - 1
+    return _codes_to_str(codes)
+
+def _decode_stream(stream):
+    # Returns (ticks, symbol offsets from EVENT_SYMBOL_BASE) for every event symbol in the stream.
+    codes = _str_to_codes(stream)
+    is_event = codes >= EVENT_SYMBOL_BASE
+    advance = np.where(is_event, 0, codes - DELAY_SYMBOL_BASE + 1)
+    return np.cumsum(advance)[is_event], codes[is_event] - EVENT_SYMBOL_BASE
+
+def _events_from_packed(ticks, packed):
+    game_events = np.zeros(len(packed), dtype=EVENT_DTYPE)
+    game_events['tick'] = ticks
+    game_events['delay'] = np.minimum(np.diff(game_events['tick'], prepend=0), np.iinfo(np.int16).max)
+    game_events['note_index'] = packed % NUM_NOTE_SYMBOLS
+    sound_volume = packed // NUM_NOTE_SYMBOLS
+    game_events['volume_index'] = sound_volume % NUM_VOLUME_LEVELS
+    game_events['sound_index'] = sound_volume // NUM_VOLUME_LEVELS
+    game_events['volume'] = VOLUME_LEVELS[game_events['volume_index']]
+    if np.any(game_events['sound_index'] >= len(GAME_SOUND_PALETTE)): raise ValueError("Song payload contains an unknown sound.")
+    return game_events
+
+def encode_v2(game_events):
+    """
+    Encodes tick-sorted game events as a single v2 song string (see the format notes above).
+    Unlike the v1 delays block, rests are never clamped.
+    """
+    return PAYLOAD_V2_HEADER + _encode_stream(game_events['tick'], event_symbols(game_events))
+
+def decode_v2(song):
+    """Decodes a v2 song string back into an EVENT_DTYPE array (tick, delay, sound, note and volume fields)."""
+    if not song.startswith(PAYLOAD_V2_HEADER): raise ValueError("Not a v2 song payload.")
+    return _events_from_packed(*_decode_stream(song[len(PAYLOAD_V2_HEADER):]))
+
+def encode_v3(game_events):
+    """
+    Encodes tick-sorted game events as a v3 song string: "v3", the song's voice table, ":",
+    then the v2 stream with each event symbol replaced by EVENT_SYMBOL_BASE + voice number.
+    A voice is one (sound, volume, note) combination written as its v2 event symbol, so the
+    player resolves names, volumes and rates once per voice instead of once per note.
+    """
+    packed = event_symbols(game_events) - EVENT_SYMBOL_BASE
+    voices, first_seen, voice_of_event = np.unique(packed, return_index=True, return_inverse=True)
+    appearance = np.argsort(first_seen)
+    voice_number = np.empty(len(voices), dtype=np.int64)
+    voice_number[appearance] = np.arange(len(voices))
+    voice_table = _codes_to_str(EVENT_SYMBOL_BASE + voices[appearance])
+    body = _encode_stream(game_events['tick'], EVENT_SYMBOL_BASE + voice_number[voice_of_event.ravel()])
+    return PAYLOAD_V3_HEADER + voice_table + VOICE_TABLE_END + body
+
+def decode_v3(song):
+    """Decodes a v3 song string back into an EVENT_DTYPE array, like decode_v2."""
+    if not song.startswith(PAYLOAD_V3_HEADER) or VOICE_TABLE_END not in song: raise ValueError("Not a v3 song payload.")
+    voice_table, body = song[len(PAYLOAD_V3_HEADER):].split(VOICE_TABLE_END, 1)
+    voices = _str_to_codes(voice_table) - EVENT_SYMBOL_BASE
+    ticks, voice_numbers = _decode_stream(body)
+    if np.any(voice_numbers >= len(voices)): raise ValueError("v3 song payload refers to a voice missing from its voice table.")
+    return _events_from_packed(ticks, voices[voice_numbers])
+
+def song_stream_start(song):
+    # Offset of the first stream symbol: after the header, and after the voice table for v3.
+    if song.startswith(PAYLOAD_V3_HEADER): return song.index(VOICE_TABLE_END) + 1
+    if song.startswith(PAYLOAD_V2_HEADER): return len(PAYLOAD_V2_HEADER)
+    raise ValueError("Keyframes need a v2 or v3 song payload.")
+
+def build_keyframe_index(song, interval_ticks):
+    """
+    Builds the seek index for a v2/v3 song: "<interval>|offset:tick,offset:tick,...". Entry k
+    points at the first tick group at or after tick k * interval_ticks, giving that group's
+    character offset in the song and its absolute tick, so a player can start anywhere after
+    skipping at most one interval of symbols.
+    """
+    start = song_stream_start(song)
+    codes = _str_to_codes(song[start:])
+    is_event = codes >= EVENT_SYMBOL_BASE
+    ticks = np.cumsum(np.where(is_event, 0, codes - DELAY_SYMBOL_BASE + 1))
+    group_starts = np.flatnonzero(is_event & ~np.concatenate(([False], is_event[:-1])))
+    if not len(group_starts): return f"{interval_ticks}|"
+    group_ticks = ticks[group_starts]
+    entries = np.searchsorted(group_ticks, np.arange(0, group_ticks[-1] + 1, interval_ticks))
+    return f"{interval_ticks}|" + ",".join(f"{start + offset}:{tick}" for offset, tick in zip(group_starts[entries].tolist(), group_ticks[entries].tolist()))
+
+def parse_keyframe_index(keyframes):
+    interval, entries = keyframes.split("|", 1)
+    pairs = [tuple(map(int, entry.split(":"))) for entry in entries.split(",") if entry]
+    return int(interval), pairs
+
+def seek(song, keyframes, start_tick):
+    """Returns (offset, wait_ticks): where to resume a v2/v3 song to play from start_tick, as the in-game player does."""
+    interval, pairs = parse_keyframe_index(keyframes)
+    if not pairs: return len(song), 0
+    offset, tick = pairs[min(max(start_tick, 0) // interval, len(pairs) - 1)]
+    while tick < start_tick and offset < len(song):
+        while offset < len(song) and ord(song[offset]) >= EVENT_SYMBOL_BASE: offset += 1
+        while offset < len(song) and ord(song[offset]) < EVENT_SYMBOL_BASE:
+            tick += ord(song[offset]) - DELAY_SYMBOL_BASE + 1
+            offset += 1
+    return offset, tick - start_tick
+
+def split_song(song, max_chars):
+    """
+    Splits a v2/v3 song into code blocks of at most max_chars characters each, for MusicPlayer.playCompactSong
+    with an array of blocks. Cuts only fall where a tick group ends and its rest begins, so tick groups
+    and rests never straddle blocks and the parts play exactly like the whole song. The header and
+    voice table stay in the first block; a block only runs over max_chars if one tick group and its
+    rest alone are longer than that.
+    """
+    start = song_stream_start(song)
+    is_event = _str_to_codes(song[start:]) >= EVENT_SYMBOL_BASE
+    cuts = start + 1 + np.flatnonzero(is_event[:-1] & ~is_event[1:])
+    parts, begin = [], 0
+    while len(song) - begin > max_chars:
+        fits = np.searchsorted(cuts, begin + max_chars, side='right') - 1
+        if fits >= 0 and cuts[fits] > begin: cut = int(cuts[fits])
+        else:
+            later = np.searchsorted(cuts, begin, side='right')
+            if later == len(cuts): break
+            cut = int(cuts[later])
+        parts.append(song[begin:cut])
+        begin = cut
+    parts.append(song[begin:])
+    return parts
+
+def split_keyframes(keyframes, max_chars):
+    """
+    Splits a keyframe index into code blocks of at most max_chars characters, cutting only after the ","
+    that ends an entry. Joined in order, the parts give back the index; MusicPlayer.playSongFrom accepts
+    them as an array. The offsets keep pointing into the whole song.
+    """
+    parts, begin = [], 0
+    while len(keyframes) - begin > max_chars:
+        cut = keyframes.rfind(",", begin, begin + max_chars) + 1
+        if cut <= begin: cut = keyframes.find(",", begin) + 1 or len(keyframes)
+        parts.append(keyframes[begin:cut])
+        begin = cut
+    parts.append(keyframes[begin:])
+    return parts
@@ -1,43 +1,34 @@
+import io
 import json
+import heapq
 import numpy as np
-import mido
 import os
-from collections import Counter, defaultdict
-from scipy.io import wavfile
-from scipy import signal
+import time
+import zipfile
+import constants
+from constants import (NOTE_INDEX_TO_CHAR_MAP, GAME_SOUND_PALETTE, SOUND_TO_INDEX, TICKS_PER_SECOND, PIANO_SOUND_DATA, MAX_DELAY_TICKS,
+                       PRIMARY_SOUND_NAME, LAYER_SOUND_NAMES, SOUND_NAMES, PAYLOAD_FORMATS, OUTPUT_PROFILES, MAX_CODE_BLOCK_CHARS, strip_extension)
 
 
-PIANO_HZ = np.array([27.50, 29.14, 30.87, 32.70, 34.65, 36.71, 38.89, 41.20, 43.65, 46.25, 49.00, 51.91, 55.00, 58.27, 61.74, 65.41, 69.30, 73.42, 77.78, 82.41, 87.31, 92.50, 98.00, 103.83, 110.00, 116.54, 123.47, 130.81, 138.59, 146.83, 155.56, 164.81, 174.61, 185.00, 196.00, 207.65, 220.00, 233.08, 246.94, 261.63, 277.18, 293.66, 311.13, 329.63, 349.23, 369.99, 392.00, 415.30, 440.00, 466.16, 493.88, 523.25, 554.37, 587.33, 622.25, 659.26, 698.46, 739.99, 783.99, 830.61, 880.00, 932.33, 987.77, 1046.50, 1108.73, 1174.66, 1244.51, 1318.51, 1396.91, 1479.98, 1567.98, 1661.22, 1760.00, 1864.66, 1975.53, 2093.00, 2217.46, 2349.32, 2489.02, 2637.02, 2793.83, 2959.96, 3135.96, 3322.44, 3520.00, 3729.31, 3951.07, 4186.01])
-NOTE_INDEX_TO_CHAR_MAP = "⁰¹²³⁴⁵⁶⁷⁸⁹ᵃᵇᶜᵈᵉᶠᵍʰⁱʲᵏˡᵐᶰⁿᵒᵖʳˢᵗᵘᵛʷˣʸᶻʱʴʵʶ₀₁₂₃₄₅₆₇₈₉ₐₑₒₓₔₕᵢⱼᵣᵤᵥₖₗₘₙₚₛₜ​‌‍⁠⁡⁢⁣⁤⁧⁩⁨⁪⁫⁬⁭⁮⁯﻿︀︁︂︃︄︅︆︇︈︉︊︋︌︍"
-
-if len(PIANO_HZ) > len(NOTE_INDEX_TO_CHAR_MAP): raise ValueError("NOTE_INDEX_TO_CHAR_MAP is not long enough for 88 keys/delays.")
-
-GAME_SOUND_PALETTE = ["harp_pling.wav", "game_start_countdown_01.wav", "game_start_countdown_02.wav", "game_start_countdown_03.wav", "game_start_countdown_final.wav"]
-SOUND_TO_INDEX = {sound: i for i, sound in enumerate(GAME_SOUND_PALETTE)}
-TICKS_PER_SECOND = 20
-PIANO_SOUND_DATA = [
-    {"filename": "harp_pling.wav", "base_pitch_hz": 260.79, "base_duration_sec": 0.84},
-    {"filename": "game_start_countdown_01.wav", "base_pitch_hz": 329.75, "base_duration_sec": 1.0},
-    {"filename": "game_start_countdown_02.wav", "base_pitch_hz": 164.84, "base_duration_sec": 0.99},
-    {"filename": "game_start_countdown_03.wav", "base_pitch_hz": 164.87, "base_duration_sec": 1.0},
-    {"filename": "game_start_countdown_final.wav", "base_pitch_hz": 658.83, "base_duration_sec": 1.58},
-]
-PRIMARY_SOUND_NAME = "harp_pling.wav"
-LAYER_SOUND_NAMES = [s['filename'] for s in PIANO_SOUND_DATA if s['filename'] != PRIMARY_SOUND_NAME]
+PIANO_HZ = np.array(constants.PIANO_HZ)
+VOLUME_LEVELS = np.array([1.0, 0.8 / 1, 0.8 / 2, 0.8 / 3, 0.8 / 4])
+NOTE_DTYPE = np.dtype([('start_tick', np.int64), ('start_time', np.float64), ('duration_sec', np.float64), ('midi_note', np.uint8), ('velocity', np.uint8)])
+EVENT_DTYPE = np.dtype([('tick', np.int64), ('delay', np.int16), ('sound_index', np.uint8), ('note_index', np.uint8), ('volume_index', np.uint8), ('volume', np.float32), ('pitch_rate', np.float64), ('velocity', np.uint8)])
 
 
 def hz_to_closest_piano_note_index(target_hz):
     return np.argmin(np.abs(PIANO_HZ - target_hz))
 
-def strip_extension(name):
-    return name[:-4] if isinstance(name, str) and name.lower().endswith('.wav') else name
-
 def get_config(user_config_data):
     default_config = {
         "palette": [strip_extension(s['filename']) for s in PIANO_SOUND_DATA],
         "layering": {
             "comment": "Max sounds per note. 1 = no layering. >1 = harp_pling + layers. max layer = 5",
             "max_layers": 2
+        },
+        "optimizer": {
+            "comment": "Max sounds played on one game tick (the game runs 50 tasks per tick). Extra layers are dropped quietest first. 0 = no limit",
+            "max_sounds_per_tick": 49
         }
     }
     for key, value in default_config.items():
@@ -45,6 +36,15 @@ def get_config(user_config_data):
             user_config_data[key] = value
     return user_config_data
 
+def normalize_config(config_data):
+    # Canonical form of a config for hashing: defaults filled in, comments dropped, palette order ignored.
+    def strip_comments(value):
+        if isinstance(value, dict): return {k: strip_comments(v) for k, v in value.items() if k != "comment"}
+        return value
+    config = strip_comments(get_config(json.loads(json.dumps(config_data))))
+    config["palette"] = sorted(set(config.get("palette", [])))
+    return config
+
 def find_piano_sounds_for_note(target_note, available_sounds, layering_config):
     max_layers = layering_config.get("max_layers", 1)
     candidates = []
@@ -70,198 +70,372 @@ def find_piano_sounds_for_note(target_note, available_sounds, layering_config):
 def midi_to_hz(note_number):
     return 440.0 * (2.0**((note_number - 69) / 12.0))
 
-def render_simulation_from_events(game_events, sound_folder, output_filename, sample_rate=44100):
-    if not game_events: return
-    print(f"\n--- Rendering game simulation preview to '{output_filename}' ---")
-    sound_data_cache = {}
-    unique_sound_files = {GAME_SOUND_PALETTE[e['sound_index']] for e in game_events}
-    sounds_loaded = 0
-    for sound_file in unique_sound_files:
-        try:
-            path = os.path.join(sound_folder, sound_file)
-            _, data_original = wavfile.read(path)
-            data_float = (data_original.astype(np.float32) / 32767.0) if np.issubdtype(data_original.dtype, np.integer) else data_original.astype(np.float32)
-            if data_float.ndim > 1: data_float = data_float.mean(axis=1)
-            sound_data_cache[sound_file] = data_float
-            sounds_loaded += 1
-        except Exception as e: print(f"    -> Warning: Could not load sound '{sound_file}': {e}")
-
-    if sounds_loaded == 0:
-        print("    -> ERROR: No sound files were loaded. Cannot render preview. Please check the --sound-folder path.")
-        return
-        
-    total_ticks = game_events[-1]['tick'] if game_events else 0
-    total_duration_sec = (total_ticks / TICKS_PER_SECOND) + 3.0
-    total_samples = int(total_duration_sec * sample_rate)
-    master_track = np.zeros(total_samples, dtype=np.float32)
-    print(f"Total song ticks: {total_ticks}. Rendering {total_duration_sec:.2f} seconds of audio...")
-
-    for event in game_events:
-        sound_index = event.get('sound_index')
-        sound_file = GAME_SOUND_PALETTE[sound_index] if sound_index is not None and 0 <= sound_index < len(GAME_SOUND_PALETTE) else None
-        if not sound_file or sound_file not in sound_data_cache: continue
-        
-        original_data = sound_data_cache[sound_file]
-        pitch_rate, volume = event['pitch_rate'], event.get('volume', 1.0)
-        
-        if pitch_rate <= 0: continue
-        
-        num_samples_resampled = int(len(original_data) / pitch_rate)
-        if num_samples_resampled == 0: continue
-        
-        resampled_data = signal.resample(original_data, num_samples_resampled) * volume
-        start_sample = int((event['tick'] / TICKS_PER_SECOND) * sample_rate)
-        
-        if start_sample < len(master_track):
-            len_to_mix = min(len(resampled_data), len(master_track) - start_sample)
-            master_track[start_sample : start_sample + len_to_mix] += resampled_data[:len_to_mix]
-
-    print("Performing final peak normalization and exporting...")
-    max_amp = np.max(np.abs(master_track))
-    if max_amp > 1.0:
-        print(f"    WARNING: Clipping detected (max amplitude: {max_amp:.2f}). Normalizing audio.")
-    
-    if max_amp > 0.0:
-        master_track /= max_amp
+MIDI_NOTE_TO_HZ = np.array([midi_to_hz(n) for n in range(128)])
+MIDI_NOTE_TO_NOTE_INDEX = np.array([hz_to_closest_piano_note_index(hz) for hz in MIDI_NOTE_TO_HZ])
+NOTE_CHARS = np.array(list(NOTE_INDEX_TO_CHAR_MAP))
+SOUND_NAME_WIDTH = 28
+
+def _iter_track_messages(track, track_index):
+    tick = 0
+    for position, msg in enumerate(track):
+        tick += msg.time
+        yield tick, track_index, position, msg
+
+def iter_midi_notes(mid):
+    """
+    Yields (start_tick, start_time, duration_sec, midi_note, velocity) for every note in the
+    file, in note-off order. Tracks are merged lazily by absolute MIDI tick, and times come
+    from a running tempo map in integer ticks, so long pieces do not accumulate float drift.
+    start_tick is already quantized to game ticks.
+    """
+    if mid.type == 2: raise TypeError("can't merge tracks in type 2 (asynchronous) file")
+    tempo, segment_tick, segment_sec = 500000, 0, 0.0
+    sec_per_tick = tempo / (1e6 * mid.ticks_per_beat)
+    active_notes = {}
+    merged = heapq.merge(*(_iter_track_messages(track, i) for i, track in enumerate(mid.tracks)))
+    for tick, _, _, msg in merged:
+        msg_type = msg.type
+        if msg_type == 'set_tempo':
+            segment_sec += (tick - segment_tick) * sec_per_tick
+            segment_tick, tempo = tick, msg.tempo
+            sec_per_tick = tempo / (1e6 * mid.ticks_per_beat)
+        elif msg_type == 'note_on' and msg.velocity > 0:
+            active_notes[(msg.channel, msg.note)] = (segment_sec + (tick - segment_tick) * sec_per_tick, msg.velocity)
+        elif msg_type == 'note_off' or msg_type == 'note_on':
+            started = active_notes.pop((msg.channel, msg.note), None)
+            if started is None: continue
+            start_time, velocity = started
+            duration = segment_sec + (tick - segment_tick) * sec_per_tick - start_time
+            if duration > 0.01:
+                yield round(start_time * TICKS_PER_SECOND), start_time, duration, msg.note, velocity
+
+def parse_midi_notes(midi_file):
+    import mido
+    mid = midi_file if isinstance(midi_file, mido.MidiFile) else mido.MidiFile(midi_file)
+    parsed_notes = np.fromiter(iter_midi_notes(mid), dtype=NOTE_DTYPE)
+    return parsed_notes[np.argsort(parsed_notes['start_time'], kind='stable')]
+
+def load_parsed_notes(midi_source, note_cache=None):
+    """
+    parse_midi_notes with an optional cache.NoteCache in front of it, keyed by the MIDI bytes.
+    Returns (parsed_notes, from_cache). MidiFile objects have no bytes to key on and are always parsed.
+    """
+    if note_cache is None or not (isinstance(midi_source, (str, os.PathLike, bytes, bytearray)) or hasattr(midi_source, 'read')): return parse_midi_notes(_open_midi(midi_source)), False
+    if isinstance(midi_source, (bytes, bytearray)): midi_bytes = bytes(midi_source)
+    elif hasattr(midi_source, 'read'): midi_bytes = midi_source.read()
+    else:
+        with open(midi_source, 'rb') as f: midi_bytes = f.read()
+    parsed_notes = note_cache.get(midi_bytes)
+    if parsed_notes is not None: return parsed_notes, True
+    parsed_notes = parse_midi_notes(_open_midi(midi_bytes))
+    note_cache.put(midi_bytes, parsed_notes)
+    return parsed_notes, False
+
+def map_notes_to_events(parsed_notes, available_sound_data, layering_config):
+    """
+    Batched equivalent of calling find_piano_sounds_for_note for every note. Rates and
+    duration fits are computed for all notes against all palette sounds at once, and
+    the layers are selected with array operations. Delays are filled in by the caller.
+    """
+    if len(parsed_notes) == 0 or not available_sound_data: return np.zeros(0, dtype=EVENT_DTYPE)
+    max_layers = layering_config.get("max_layers", 1)
+    num_notes = len(parsed_notes)
+    midi_notes = parsed_notes['midi_note']
+    pitch_hz = MIDI_NOTE_TO_HZ[midi_notes]
+    duration_sec = parsed_notes['duration_sec']
+
+    base_pitch_hz = np.array([s['base_pitch_hz'] for s in available_sound_data])
+    base_duration_sec = np.array([s['base_duration_sec'] for s in available_sound_data])
+    is_primary = np.array([s['filename'] == PRIMARY_SOUND_NAME for s in available_sound_data])
+    palette_sound_index = np.array([SOUND_TO_INDEX[s['filename']] for s in available_sound_data])
+
+    rate = pitch_hz[:, None] / base_pitch_hz[None, :]
+    pitched_duration = base_duration_sec[None, :] / rate
+    duration_diff = np.abs(duration_sec[:, None] - pitched_duration)
+    is_candidate = is_primary[None, :] | (pitched_duration <= duration_sec[:, None])
+    order = np.argsort(np.where(is_candidate, duration_diff, np.inf), axis=1, kind='stable')
+    sorted_candidate = np.take_along_axis(is_candidate, order, axis=1)
+
+    if max_layers <= 1:
+        chosen = np.where(sorted_candidate[:, :1], order[:, :1], -1)
     else:
-        print("    WARNING: Rendered audio is completely silent.")
+        layer_candidate = sorted_candidate & ~is_primary[order]
+        num_layers_to_add = max_layers - 1 if is_primary.any() else max_layers
+        taken = layer_candidate & (np.cumsum(layer_candidate, axis=1) <= num_layers_to_add)
+        compacted = np.argsort(~taken, axis=1, kind='stable')
+        chosen = np.take_along_axis(np.where(taken, order, -1), compacted, axis=1)[:, :num_layers_to_add]
+        if is_primary.any():
+            chosen = np.hstack([np.full((num_notes, 1), np.argmax(is_primary)), chosen])
+
+    note_ids, slot_ids = np.nonzero(chosen >= 0)
+    palette_ids = chosen[note_ids, slot_ids]
+    num_layers = np.count_nonzero((chosen >= 0) & ~is_primary[np.maximum(chosen, 0)], axis=1)[note_ids]
+    volume_index = np.where(is_primary[palette_ids], 0, num_layers)
+
+    game_events = np.zeros(len(note_ids), dtype=EVENT_DTYPE)
+    game_events['tick'] = parsed_notes['start_tick'][note_ids]
+    game_events['sound_index'] = palette_sound_index[palette_ids]
+    game_events['note_index'] = MIDI_NOTE_TO_NOTE_INDEX[midi_notes[note_ids]]
+    game_events['volume_index'] = volume_index
+    game_events['volume'] = VOLUME_LEVELS[volume_index]
+    game_events['pitch_rate'] = rate[note_ids, palette_ids]
+    game_events['velocity'] = parsed_notes['velocity'][note_ids]
+    return game_events
+
+def sort_and_compute_delays(game_events):
+    game_events = game_events[np.argsort(game_events['tick'], kind='stable')]
+    game_events['delay'] = np.minimum(np.diff(game_events['tick'], prepend=0), MAX_DELAY_TICKS)
+    return game_events
 
-    wavfile.write(output_filename, sample_rate, (master_track * 32767).astype(np.int16))
-    print(f"Successfully rendered simulation to '{output_filename}'!")
+def encode_events(game_events):
+    return {
+        "sounds": (game_events['sound_index'] + ord('0')).astype(np.uint8).tobytes().decode('ascii'),
+        "delays": "".join(NOTE_CHARS[game_events['delay']].tolist()),
+        "notes": "".join(NOTE_CHARS[game_events['note_index']].tolist()),
+        "volumes": (game_events['volume_index'] + ord('0')).astype(np.uint8).tobytes().decode('ascii'),
+    }
+
+def encode_payload(game_events, payload_format="v1", keyframe_interval=None):
+    """
+    Returns the in-game code blocks for a payload format, in paste order: {block_name: text}.
+    keyframe_interval (ticks, v2/v3 only) adds a "keyframes" block for seeking with playSongFrom.
+    """
+    if payload_format not in PAYLOAD_FORMATS: raise ValueError(f"Unknown payload format '{payload_format}'. Choose from: {', '.join(PAYLOAD_FORMATS)}.")
+    if keyframe_interval and payload_format == "v1": raise ValueError("Keyframes need the v2 or v3 payload format.")
+    if payload_format == "v1": return encode_events(game_events)
 
-def run_processing(midi_file_path, config_data, render_preview_flag, sound_folder_path):
+    from payload import encode_v2, encode_v3, build_keyframe_index
+    blocks = {"song": encode_v2(game_events) if payload_format == "v2" else encode_v3(game_events)}
+    if keyframe_interval: blocks["keyframes"] = build_keyframe_index(blocks["song"], keyframe_interval)
+    return blocks
+
+def chunk_payload(payload, payload_format, max_chars=MAX_CODE_BLOCK_CHARS):
     """
-    This function takes inputs from the Streamlit app, runs the core MIDI processing logic,
-    and returns the path to a directory containing the output files.
+    Splits each code block into parts of at most max_chars characters: {block_name: [part, ...]}.
+    v1 streams are all cut after the same number of events, a multiple of the player's note chunk,
+    so the four blocks stay aligned and play exactly as one. v2/v3 songs are cut between tick groups
+    (see payload.split_song). The keyframe index is cut between entries (see payload.split_keyframes)
+    and its offsets still count characters across the whole song.
     """
+    if not max_chars: return {block: [text] for block, text in payload.items()}
+    if payload_format == "v1":
+        from scheduler_sim import CHUNK_SIZE_IN_NOTES
+        events_per_part = max(CHUNK_SIZE_IN_NOTES, max_chars // CHUNK_SIZE_IN_NOTES * CHUNK_SIZE_IN_NOTES)
+        return {block: [text[i:i + events_per_part] for i in range(0, max(len(text), 1), events_per_part)] for block, text in payload.items()}
+    from payload import split_song, split_keyframes
+    return {block: split_song(text, max_chars) if block == "song" else split_keyframes(text, max_chars) for block, text in payload.items()}
+
+def build_reports(game_events):
+    counts = np.bincount(game_events['sound_index'], minlength=len(GAME_SOUND_PALETTE))
+    used_indices, first_seen = np.unique(game_events['sound_index'], return_index=True)
+    sounds_used = sorted(SOUND_NAMES[i] for i in used_indices.tolist())
+    in_order_of_appearance = used_indices[np.argsort(first_seen)].tolist()
+    mapping_report = dict(sorted(((SOUND_NAMES[i], int(counts[i])) for i in in_order_of_appearance), key=lambda item: item[1], reverse=True))
+    return sounds_used, mapping_report
+
+def format_note_log(game_events):
+    # Songs reuse a few hundred distinct sound/volume/note lines, so each is formatted once and the log is assembled by index.
+    fields = ('sound_index', 'volume_index', 'note_index', 'volume', 'pitch_rate')
+    packed = np.empty(len(game_events), dtype=[(name, game_events.dtype[name]) for name in fields])
+    for name in fields: packed[name] = game_events[name]
+    _, first_event, voice_of_event = np.unique(packed.view(f"V{packed.dtype.itemsize}"), return_index=True, return_inverse=True)
+    columns = (packed[name][first_event].tolist() for name in fields)
+    voice_lines = np.array([f"    - Sound: {SOUND_NAMES[sound_index]:<{SOUND_NAME_WIDTH}} | Vol Idx: {volume_index} | Note Char: {NOTE_INDEX_TO_CHAR_MAP[note_index]} | (Sim Vol: {volume:.2f}, Sim Rate: {pitch_rate:.2f})\n"
+                            for sound_index, volume_index, note_index, volume, pitch_rate in zip(*columns)], dtype=object)
+    tick_starts = np.flatnonzero(np.diff(game_events['tick'], prepend=-1))
+    lines = np.empty(len(game_events) + len(tick_starts), dtype=object)
+    header_rows = tick_starts + np.arange(len(tick_starts))
+    lines[header_rows] = [f"Tick: {tick:04d} ({tick / TICKS_PER_SECOND:.2f}s)\n" for tick in game_events['tick'][tick_starts].tolist()]
+    event_rows = np.ones(len(lines), dtype=bool)
+    event_rows[header_rows] = False
+    lines[event_rows] = voice_lines[voice_of_event.ravel()]
+    return "".join(lines.tolist())
+
+def conversion_stages(render_preview, scheduler_check=None, output_profile="full"):
+    return (["parse", "mapping", "optimize", "encoding"] + (["reports"] if output_profile == "full" else [])
+            + (["scheduler"] if scheduler_check else []) + (["preview"] if render_preview else []))
+
+
+class StageTimer:
+    """
+    Times pipeline stages and reports each one to an optional progress callback as a dict:
+    {"stage", "status": "started"/"finished", "items", "elapsed"}. Finished stages are also
+    collected in .timings as {stage: {"items", "seconds"}}.
+    """
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.timings = {}
+        self._stage = None
+        self._started = 0.0
+
+    def start(self, stage):
+        self._stage, self._started = stage, time.perf_counter()
+        if self.progress: self.progress({"stage": stage, "status": "started", "items": 0, "elapsed": 0.0})
+
+    def finish(self, items):
+        elapsed = time.perf_counter() - self._started
+        self.timings[self._stage] = {"items": int(items), "seconds": elapsed}
+        if self.progress: self.progress({"stage": self._stage, "status": "finished", "items": int(items), "elapsed": elapsed})
+
+
+class MidiFormatError(ValueError):
+    """Uploaded MIDI data that mido cannot read."""
+
+def _open_midi(midi_source):
+    import mido
+    if isinstance(midi_source, mido.MidiFile): return midi_source
+    if not isinstance(midi_source, (bytes, bytearray)) and not hasattr(midi_source, 'read'): return mido.MidiFile(midi_source)
+    try:
+        return mido.MidiFile(file=io.BytesIO(midi_source) if isinstance(midi_source, (bytes, bytearray)) else midi_source)
+    except (OSError, EOFError, ValueError, KeyError, IndexError) as e:
+        raise MidiFormatError(f"Not a readable MIDI file ({type(e).__name__}{': ' + str(e) if str(e) else ''}).") from e
+
+def render_preview_wav(game_events, sound_folder_path="sounds", preview_quality="full", render_workers=1, mix_engine="auto"):
+    """Renders the preview of game_events in memory and returns the WAV bytes, or None if nothing could be rendered."""
+    from renderer import render_simulation_from_events
+    preview_buffer = io.BytesIO()
+    render_simulation_from_events(game_events, sound_folder_path, preview_buffer, render_workers=render_workers, mix_engine=mix_engine, quality=preview_quality)
+    return preview_buffer.getvalue() if preview_buffer.getbuffer().nbytes else None
+
+def convert_midi(midi_source, config_data, render_preview=False, sound_folder_path="sounds", name=None, progress=None, payload_format="v1", scheduler_check=None, keyframe_interval=None, render_workers=1, mix_engine="auto", preview_quality="full", note_cache=None, output_profile="full", chunk_chars=MAX_CODE_BLOCK_CHARS):
+    """
+    Runs the whole conversion in memory. midi_source may be a path, raw MIDI bytes or a file
+    object. Returns a dict with the code blocks encoded in payload_format ("payload"), the
+    note log, both reports, the event array, per-stage timings and (if render_preview) the preview WAV bytes, or None if
+    no notes were mapped. Nothing is written to disk; see write_outputs for the file sink.
+    progress, if given, is called with the stage events described in StageTimer.
+    scheduler_check ("warn" or "fail") replays the payload through the in-game scheduler model
+    and stores the load report as "scheduler_report"; "fail" raises SchedulerBudgetError
+    instead of returning a song that would drop notes.
+    preview_quality="draft" renders a quick low-rate preview of the opening instead (see renderer).
+    note_cache (a cache.NoteCache) lets a MIDI that was parsed before skip the parse stage.
+    output_profile="lean" skips the reports stage; sounds_used, mapping_report and note_log are then None.
+    "payload_chunks" holds each block split into code blocks of at most chunk_chars characters (None = unsplit).
+    """
+    if output_profile not in OUTPUT_PROFILES: raise ValueError(f"Unknown output profile '{output_profile}'. Choose from: {', '.join(OUTPUT_PROFILES)}.")
+    timer = StageTimer(progress)
     config = get_config(config_data)
+    if name is None: name = os.path.splitext(os.path.basename(midi_source))[0] if isinstance(midi_source, str) else "song"
 
     palette_from_config = set(config.get('palette', []))
     available_sound_data = [s for s in PIANO_SOUND_DATA if strip_extension(s['filename']) in palette_from_config]
     print(f"\n--- Using a palette of {len(available_sound_data)} sounds from config ---")
-    print(f"\n--- Pass 1: Parsing MIDI file '{os.path.basename(midi_file_path)}' ---")
-    mid = mido.MidiFile(midi_file_path)
-    parsed_notes = []
-    active_notes = {}
-    absolute_time_sec = 0.0
-    for msg in mid:
-        absolute_time_sec += msg.time
-        if msg.type == 'note_on' and msg.velocity > 0:
-            active_notes[(msg.channel, msg.note)] = (absolute_time_sec, msg.velocity)
-        elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-            key = (msg.channel, msg.note)
-            if key in active_notes:
-                start_time, velocity = active_notes.pop(key)
-                duration = absolute_time_sec - start_time
-                if duration > 0.01:
-                    parsed_notes.append({"start_time": start_time, "pitch_hz": midi_to_hz(msg.note), "duration_sec": duration, "velocity": velocity})
-    
-    parsed_notes.sort(key=lambda x: x['start_time'])
-    print(f"Found and sorted {len(parsed_notes)} notes.")
+    print(f"\n--- Pass 1: Parsing MIDI file '{name}' ---")
+    timer.start("parse")
+    parsed_notes, from_cache = load_parsed_notes(midi_source, note_cache)
+    timer.finish(len(parsed_notes))
+    print(f"Found and sorted {len(parsed_notes)} notes{' (from the note cache)' if from_cache else ''}.")
     print(f"--- Pass 2: Mapping notes, quantizing data, and applying volume budget ---")
-    game_events = []
-    last_tick = 0
-    for note in parsed_notes:
-        chosen_sounds = find_piano_sounds_for_note(note, available_sound_data, config['layering'])
-        if not chosen_sounds:
-            continue
-
-        note_index = hz_to_closest_piano_note_index(note['pitch_hz'])
-        note_char = NOTE_INDEX_TO_CHAR_MAP[note_index]
-
-        layer_sounds = [s for s in chosen_sounds if s['filename'] != PRIMARY_SOUND_NAME]
-        num_layers = len(layer_sounds)
-        for sound in chosen_sounds:
-            if sound['filename'] == PRIMARY_SOUND_NAME:
-                sound['volume'] = 1.0
-                sound['volume_index'] = 0
-            else:
-                sound['volume'] = 0.8 / num_layers if num_layers > 0 else 0
-                sound['volume_index'] = num_layers
-        
-        current_tick = round(note['start_time'] * TICKS_PER_SECOND)
-        delay = current_tick - last_tick
-        if delay < 0:
-            delay = 0
-        
-        for sound in chosen_sounds:
-            game_events.append({
-                'sound_index': SOUND_TO_INDEX[sound['filename']],
-                'note_char': note_char,
-                'delay': delay,
-                'pitch_rate': sound['rate'],
-                'sound_name': strip_extension(sound['filename']),
-                'tick': current_tick,
-                'volume': sound['volume'],
-                'volume_index': sound['volume_index']
-            })
-            delay = 0
-        last_tick = current_tick
-
-    game_events.sort(key=lambda e: e['tick'])
-    last_tick = 0
-    for event in game_events:
-        delay = event['tick'] - last_tick
-        event['delay'] = min(delay, 87)
-        last_tick = event['tick']
-
-    if game_events:
-        base_name = os.path.splitext(os.path.basename(midi_file_path))[0]
-        output_dir = os.path.join("results", base_name)
-        os.makedirs(output_dir, exist_ok=True)
-        
-        print(f"\n--- Pass 3: Generating output files in '{output_dir}' ---")
-        sounds_path = os.path.join(output_dir, f"1_{base_name}_sounds.txt")
-        delays_path = os.path.join(output_dir, f"2_{base_name}_delays.txt")
-        notes_path = os.path.join(output_dir, f"3_{base_name}_notes.txt")
-        volumes_path = os.path.join(output_dir, f"4_{base_name}_volumes.txt")
-        log_file_path = os.path.join(output_dir, f"5_{base_name}_note_log.txt")
-        sounds_used_path = os.path.join(output_dir, f"6_{base_name}_sounds_used.json")
-        mapping_report_path = os.path.join(output_dir, f"7_{base_name}_mapping_report.json")
-        preview_path = os.path.join(output_dir, f"8_{base_name}_preview.wav")
-
-        sounds_str = "".join([str(e['sound_index']) for e in game_events])
-        notes_str = "".join([e['note_char'] for e in game_events])
-        delays_str = "".join([NOTE_INDEX_TO_CHAR_MAP[e['delay']] for e in game_events])
-        volumes_str = "".join([str(e['volume_index']) for e in game_events])
-
-        with open(sounds_path, "w") as f: f.write(sounds_str)
-        with open(delays_path, "w") as f: f.write(delays_str)
-        with open(notes_path, "w") as f: f.write(notes_str)
-        with open(volumes_path, "w") as f: f.write(volumes_str)
-        
-        sounds_used = sorted(list(set([e['sound_name'] for e in game_events])))
-        with open(sounds_used_path, 'w') as f: json.dump(sounds_used, f, indent=4)
-
-        mapping_report = dict(sorted(Counter([e['sound_name'] for e in game_events]).items(), key=lambda item: item[1], reverse=True))
-        with open(mapping_report_path, 'w') as f: json.dump(mapping_report, f, indent=4)
-
-        print(f"\nSuccessfully exported compact song data and reports to '{output_dir}':\n"
-              f"  - 1. Sounds Data:   '{os.path.basename(sounds_path)}'\n"
-              f"  - 2. Delays Data:   '{os.path.basename(delays_path)}'\n"
-              f"  - 3. Notes Data:    '{os.path.basename(notes_path)}'\n"
-              f"  - 4. Volumes Data:  '{os.path.basename(volumes_path)}'\n"
-              f"  - 5. Note Log:      '{os.path.basename(log_file_path)}'\n"
-              f"  - 6. Sounds Used:   '{os.path.basename(sounds_used_path)}'\n"
-              f"  - 7. Mapping Rpt:   '{os.path.basename(mapping_report_path)}'")
-        
-        print(f"\n--- Generating clear note log to '{os.path.basename(log_file_path)}' ---")
-        events_by_tick = defaultdict(list)
-        for event in game_events: events_by_tick[event['tick']].append(event)
-        
-        with open(log_file_path, "w") as log_file:
-            for tick in sorted(events_by_tick.keys()):
-                time_sec = tick / TICKS_PER_SECOND
-                events_at_this_tick = events_by_tick[tick]
-                log_file.write(f"Tick: {tick:04d} ({time_sec:.2f}s)\n")
-                for event in events_at_this_tick:
-                    log_file.write(f"    - Sound: {event['sound_name']:<28} | Vol Idx: {event['volume_index']} | Note Char: {event['note_char']} | (Sim Vol: {event.get('volume', 1.0):.2f}, Sim Rate: {event['pitch_rate']:.2f})\n")
-        print(f"Successfully generated note log!")
-        
-        if render_preview_flag:
-            render_simulation_from_events(game_events, sound_folder_path, preview_path)
-        
-        return output_dir 
-    else:
-        print("\nNo valid notes were mapped. No output files generated.")
-        return None 
\ No newline at end of file
+    timer.start("mapping")
+    game_events = map_notes_to_events(parsed_notes, available_sound_data, config['layering'])
+    game_events = sort_and_compute_delays(game_events)
+    timer.finish(len(game_events))
+
+    if not len(game_events):
+        print("\nNo valid notes were mapped.")
+        return None
+
+    from optimizer import optimize_events, format_optimizer_report
+    timer.start("optimize")
+    game_events, optimizer_report = optimize_events(game_events, config['optimizer'])
+    timer.finish(len(game_events))
+    print(format_optimizer_report(optimizer_report))
+
+    print(f"--- Pass 3: Encoding {len(game_events)} events ---")
+    timer.start("encoding")
+    result = {"name": name, "events": game_events, "payload_format": payload_format, "payload": encode_payload(game_events, payload_format, keyframe_interval)}
+    result["payload_chunks"] = chunk_payload(result["payload"], payload_format, chunk_chars)
+    timer.finish(len(game_events))
+    result["output_profile"] = output_profile
+    result["optimizer_report"] = optimizer_report
+    result["sounds_used"] = result["mapping_report"] = result["note_log"] = None
+    if output_profile == "full":
+        timer.start("reports")
+        result["sounds_used"], result["mapping_report"] = build_reports(game_events)
+        result["note_log"] = format_note_log(game_events)
+        timer.finish(len(game_events))
+    if scheduler_check:
+        from scheduler_sim import simulate_payload, exceeds_budget, format_scheduler_report, SchedulerBudgetError
+        timer.start("scheduler")
+        result["scheduler_report"] = simulate_payload(result["payload"], payload_format)
+        timer.finish(len(game_events))
+        print(f"\n{format_scheduler_report(result['scheduler_report'])}")
+        if scheduler_check == "fail" and exceeds_budget(result["scheduler_report"]):
+            raise SchedulerBudgetError(f"'{name}' would drop {result['scheduler_report']['broadcasts_dropped']} notes and {result['scheduler_report']['dropped_chunk_tasks']} chunk tasks in game.")
+    result["preview_wav"] = None
+
+    if render_preview:
+        timer.start("preview")
+        result["preview_wav"] = render_preview_wav(game_events, sound_folder_path, preview_quality, render_workers, mix_engine)
+        result["preview_quality"] = preview_quality
+        timer.finish(len(game_events))
+    result["timings"] = timer.timings
+    return result
+
+OUTPUT_WRITE_BUFFER_BYTES = 1024 * 1024
+
+def output_files(result):
+    """
+    The output artifacts of a conversion result as an ordered list of (file name, label, bytes):
+    the code blocks (one file per part when a block was chunked), then (full profile) the note log and reports, then the preview WAV if there is one.
+    Every file is encoded up front, so sinks write each one with a single call.
+    """
+    base_name = result["name"]
+    files = []
+    for i, (block, text) in enumerate(result["payload"].items(), start=1):
+        parts = result.get("payload_chunks", {}).get(block, [text])
+        if len(parts) == 1: files.append((f"{i}_{base_name}_{block}.txt", f"{block.capitalize()} Data:", text.encode("utf-8")))
+        else: files += [(f"{i}_{base_name}_{block}_part{j}.txt", f"{block.capitalize()} Data {j}/{len(parts)}:", part.encode("utf-8")) for j, part in enumerate(parts, start=1)]
+    if result.get("output_profile", "full") == "full":
+        files += [(f"5_{base_name}_note_log.txt", "Note Log:", result["note_log"].encode("utf-8")),
+                  (f"6_{base_name}_sounds_used.json", "Sounds Used:", json.dumps(result["sounds_used"], indent=4).encode()),
+                  (f"7_{base_name}_mapping_report.json", "Mapping Rpt:", json.dumps(result["mapping_report"], indent=4).encode()),
+                  (f"9_{base_name}_optimizer_report.json", "Optimizer Rpt:", json.dumps(result["optimizer_report"], indent=4).encode())]
+    if result.get("preview_wav"): files.append((f"8_{base_name}_preview.wav", "Preview:", result["preview_wav"]))
+    return files
+
+def package_outputs(result):
+    """Returns output_files(result) as the bytes of one zip archive, for downloads."""
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        for file_name, _, data in output_files(result):
+            zip_file.writestr(file_name, data, compress_type=zipfile.ZIP_STORED if file_name.endswith(".wav") else zipfile.ZIP_DEFLATED)
+    return archive.getvalue()
+
+def write_outputs(result, output_dir):
+    base_name = result["name"]
+    os.makedirs(output_dir, exist_ok=True)
+
+    print(f"\n--- Writing output files to '{output_dir}' ---")
+    files = output_files(result)
+    for file_name, _, data in files:
+        with open(os.path.join(output_dir, file_name), "wb", buffering=OUTPUT_WRITE_BUFFER_BYTES) as f: f.write(data)
+
+    summary = "".join(f"  - {file_name.split('_', 1)[0]}. {label:<{max(15, len(label) + 1)}}'{file_name}'\n" for file_name, label, _ in files if not file_name.endswith(".wav"))
+    print(f"\nSuccessfully exported compact song data ({result['payload_format']}) and {'reports' if result.get('output_profile', 'full') == 'full' else 'no reports (lean profile)'} to '{output_dir}':\n"
+          f"{summary.rstrip()}")
+    return os.path.join(output_dir, f"8_{base_name}_preview.wav")
+
+def run_processing(midi_file_path, config_data, render_preview_flag, sound_folder_path, stream_preview=False, progress=None, payload_format="v1", scheduler_check=None, keyframe_interval=None, render_workers=1, mix_engine="auto", preview_quality="full", preview_seconds=None, note_cache=None, output_profile="full", chunk_chars=MAX_CODE_BLOCK_CHARS, output_dir=None):
+    """
+    Converts a MIDI file and writes all output files to output_dir (default results/<basename>/).
+    Returns the path to that directory, or None if no notes could be mapped.
+    Besides the convert_midi stages, progress also receives "write" and "preview".
+    """
+    result = convert_midi(midi_file_path, config_data, False, sound_folder_path, progress=progress, payload_format=payload_format, scheduler_check=scheduler_check, keyframe_interval=keyframe_interval, note_cache=note_cache, output_profile=output_profile, chunk_chars=chunk_chars)
+    if result is None:
+        print("No output files generated.")
+        return None
+
+    timer = StageTimer(progress)
+    output_dir = output_dir or os.path.join("results", result["name"])
+    timer.start("write")
+    preview_path = write_outputs(result, output_dir)
+    timer.finish(len(result["events"]))
+    if render_preview_flag:
+        from renderer import render_simulation_from_events
+        timer.start("preview")
+        render_simulation_from_events(result["events"], sound_folder_path, preview_path, streaming=stream_preview, render_workers=render_workers, mix_engine=mix_engine,
+                                      quality=preview_quality, max_seconds=preview_seconds)
+        timer.finish(len(result["events"]))
+    return output_dir
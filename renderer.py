@@ -0,0 +1,346 @@
+import os
+import threading
+import wave
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.io import wavfile
+from scipy import signal
+from constants import GAME_SOUND_PALETTE, PIANO_SOUND_DATA, TICKS_PER_SECOND, MIX_ENGINES, PREVIEW_QUALITIES
+SOUND_BASE_HZ = {s['filename']: s['base_pitch_hz'] for s in PIANO_SOUND_DATA}
+PREVIEW_SAMPLE_RATE = 44100
+# Draft previews trade fidelity for speed: half the sample rate, linear-interpolated pitching, first 30 seconds only.
+DRAFT_SAMPLE_RATE = 22050
+DRAFT_MAX_SECONDS = 30.0
+# Rough per-sample and per-event costs of the two mixing methods, measured with numpy/scipy on one core.
+DIRECT_SECONDS_PER_SAMPLE = 0.5e-9
+DIRECT_SECONDS_PER_EVENT = 3e-6
+CONVOLUTION_SECONDS_PER_SAMPLE = 5e-8
+
+
+def game_pitch_rate(sound_file, note_index):
+    # Same formula the in-game MusicPlayer uses, so the preview hears what the game plays.
+    return 440.0 * (2.0**((note_index - 48) / 12.0)) / SOUND_BASE_HZ[sound_file]
+
+
+class PitchBank:
+    """
+    Bounded LRU cache of pre-pitched sound buffers keyed by (sound_index, note_index).
+    Each buffer is resampled once and then reused for every event with the same pitch.
+    rate_scale shrinks buffers for output rates below PREVIEW_SAMPLE_RATE, and
+    linear=True pitches by linear interpolation instead of the slower FFT resample.
+    """
+    def __init__(self, sound_data_cache, max_bytes=128 * 1024 * 1024, rate_scale=1.0, linear=False):
+        self.sound_data_cache = sound_data_cache
+        self.max_bytes = max_bytes
+        self.rate_scale = rate_scale
+        self.linear = linear
+        self.buffers = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def pitched_length(self, sound_file, note_index):
+        return int(len(self.sound_data_cache[sound_file]) / game_pitch_rate(sound_file, note_index) * self.rate_scale)
+
+    def get(self, sound_index, note_index):
+        key = (sound_index, note_index)
+        buffer = self.buffers.get(key)
+        if buffer is not None:
+            self.buffers.move_to_end(key)
+            self.hits += 1
+            return buffer
+
+        self.misses += 1
+        sound_file = GAME_SOUND_PALETTE[sound_index]
+        original_data = self.sound_data_cache[sound_file]
+        num_samples_resampled = self.pitched_length(sound_file, note_index)
+        if num_samples_resampled == 0: return None
+
+        if self.linear:
+            positions = np.arange(num_samples_resampled) * (len(original_data) / num_samples_resampled)
+            buffer = np.interp(positions, np.arange(len(original_data)), original_data).astype(np.float32)
+        else:
+            buffer = signal.resample(original_data, num_samples_resampled).astype(np.float32)
+        self.buffers[key] = buffer
+        self.total_bytes += buffer.nbytes
+        while self.total_bytes > self.max_bytes and len(self.buffers) > 1:
+            _, evicted = self.buffers.popitem(last=False)
+            self.total_bytes -= evicted.nbytes
+        return buffer
+
+    def discard(self, sound_file):
+        for key in [key for key in self.buffers if GAME_SOUND_PALETTE[key[0]] == sound_file]:
+            self.total_bytes -= self.buffers.pop(key).nbytes
+
+
+def _read_wav(path):
+    # Memory-mapped where scipy supports it (uncompressed PCM); the float32 copy below is what gets kept.
+    try:
+        return wavfile.read(path, mmap=True)
+    except ValueError:
+        return wavfile.read(path)
+
+
+class SoundBank:
+    """
+    Process-wide store of the decoded sounds in one folder, as float32 mono. Each WAV is read
+    once and only re-read if it changes on disk; any file in the folder can be added with load().
+    The bank also owns the pitch banks (one full quality, one per draft sample rate), so
+    pitched buffers are reused across renders. Get the instance with SoundBank.shared(folder).
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, sound_folder):
+        self.sound_folder = sound_folder
+        self.sounds = {}
+        self.info = {}
+        self.pitch_bank = PitchBank(self.sounds)
+        self.draft_pitch_banks = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, sound_folder):
+        sound_folder = os.path.abspath(sound_folder)
+        with cls._instances_lock:
+            if sound_folder not in cls._instances: cls._instances[sound_folder] = cls(sound_folder)
+            return cls._instances[sound_folder]
+
+    def draft_pitch_bank(self, sample_rate):
+        with self._lock:
+            if sample_rate not in self.draft_pitch_banks:
+                self.draft_pitch_banks[sample_rate] = PitchBank(self.sounds, rate_scale=sample_rate / PREVIEW_SAMPLE_RATE, linear=True)
+            return self.draft_pitch_banks[sample_rate]
+
+    def load(self, sound_files):
+        """Makes sure the given files are loaded and current, and returns {filename: samples} for those available."""
+        with self._lock:
+            for sound_file in sound_files:
+                path = os.path.join(self.sound_folder, sound_file)
+                try:
+                    modified = os.stat(path).st_mtime_ns
+                    if sound_file in self.sounds and self.info[sound_file]["modified_ns"] == modified: continue
+                    sample_rate, data_original = _read_wav(path)
+                    data_float = (data_original.astype(np.float32) / 32767.0) if np.issubdtype(data_original.dtype, np.integer) else data_original.astype(np.float32)
+                    if data_float.ndim > 1: data_float = data_float.mean(axis=1)
+                except Exception as e:
+                    if sound_file not in self.sounds: print(f"    -> Warning: Could not load sound '{sound_file}': {e}")
+                    continue
+                for pitch_bank in [self.pitch_bank, *self.draft_pitch_banks.values()]: pitch_bank.discard(sound_file)
+                self.sounds[sound_file] = data_float
+                self.info[sound_file] = {"modified_ns": modified, "sample_rate": sample_rate, "frames": len(data_float), "duration_sec": len(data_float) / sample_rate}
+                self._validate(sound_file)
+            return {sound_file: self.sounds[sound_file] for sound_file in sound_files if sound_file in self.sounds}
+
+    def _validate(self, sound_file):
+        expected = next((s for s in PIANO_SOUND_DATA if s['filename'] == sound_file), None)
+        if expected is None:
+            print(f"    -> Warning: Sound '{sound_file}' has no entry in PIANO_SOUND_DATA; it can be loaded but not pitched.")
+            return
+        duration_sec = self.info[sound_file]["duration_sec"]
+        if abs(duration_sec - expected['base_duration_sec']) > 0.05 * expected['base_duration_sec']:
+            print(f"    -> Warning: Sound '{sound_file}' lasts {duration_sec:.2f}s but PIANO_SOUND_DATA expects {expected['base_duration_sec']:.2f}s. Is it the right file?")
+
+def _iter_event_buffers(game_events, pitch_bank, sample_rate):
+    columns = (game_events['tick'].tolist(), game_events['sound_index'].tolist(), game_events['note_index'].tolist(), game_events['volume'])
+    for tick, sound_index, note_index, volume in zip(*columns):
+        sound_file = GAME_SOUND_PALETTE[sound_index] if 0 <= sound_index < len(GAME_SOUND_PALETTE) else None
+        if not sound_file or sound_file not in pitch_bank.sound_data_cache: continue
+
+        resampled_data = pitch_bank.get(sound_index, note_index)
+        if resampled_data is None: continue
+
+        start_sample = int((tick / TICKS_PER_SECOND) * sample_rate)
+        yield start_sample, resampled_data, volume
+
+def _mix_full(game_events, pitch_bank, sample_rate, total_samples):
+    master_track = np.zeros(total_samples, dtype=np.float32)
+    for start_sample, resampled_data, volume in _iter_event_buffers(game_events, pitch_bank, sample_rate):
+        if start_sample < len(master_track):
+            len_to_mix = min(len(resampled_data), len(master_track) - start_sample)
+            master_track[start_sample : start_sample + len_to_mix] += resampled_data[:len_to_mix] * volume
+    return master_track
+
+def _mix_convolved(game_events, pitch_bank, sample_rate, total_samples, engine):
+    """
+    Mixes each (sound, note) pair as one impulse train of start samples and volumes, FFT-convolved
+    with that pair's pitched buffer, so its cost follows the pair's time span instead of how often
+    it repeats. With engine="auto" only pairs predicted to be cheaper that way are convolved; the
+    rest go through _mix_full unchanged, so a song with no dense pairs renders exactly as before.
+    """
+    starts = np.array([int((tick / TICKS_PER_SECOND) * sample_rate) for tick in game_events['tick'].tolist()], dtype=np.int64)
+    pairs = game_events['sound_index'].astype(np.int64) * 256 + game_events['note_index']
+    order = np.argsort(pairs, kind='stable')
+    group_starts = np.flatnonzero(np.diff(pairs[order], prepend=-1))
+    convolved = np.zeros(len(game_events), dtype=bool)
+    trains = []
+    for ids in np.split(order, group_starts[1:]):
+        sound_index, note_index = int(game_events['sound_index'][ids[0]]), int(game_events['note_index'][ids[0]])
+        if GAME_SOUND_PALETTE[sound_index] not in pitch_bank.sound_data_cache: continue
+        pitched_length = pitch_bank.pitched_length(GAME_SOUND_PALETTE[sound_index], note_index)
+        span = int(starts[ids].max() - starts[ids].min()) + pitched_length
+        direct_cost = len(ids) * (pitched_length * DIRECT_SECONDS_PER_SAMPLE + DIRECT_SECONDS_PER_EVENT)
+        if pitched_length == 0 or (engine == "auto" and span * CONVOLUTION_SECONDS_PER_SAMPLE >= direct_cost): continue
+        convolved[ids] = True
+        trains.append((sound_index, note_index, ids))
+
+    master_track = _mix_full(game_events[~convolved], pitch_bank, sample_rate, total_samples)
+    for sound_index, note_index, ids in trains:
+        buffer = pitch_bank.get(sound_index, note_index)
+        first = int(starts[ids].min())
+        if first >= total_samples: continue
+        train = np.zeros(int(starts[ids].max()) - first + 1, dtype=np.float32)
+        np.add.at(train, starts[ids] - first, game_events['volume'][ids])
+        end = min(first + len(train) + len(buffer) - 1, total_samples)
+        master_track[first:end] += signal.oaconvolve(train, buffer)[:end - first]
+    if trains or engine == "convolution": print(f"Convolution mixing: {len(trains)} of {len(group_starts)} pitches ({int(convolved.sum())} of {len(game_events)} events).")
+    return master_track
+
+def _event_spans(game_events, sound_data_cache, sample_rate):
+    # (start_sample, num_samples) of every event's pitched buffer, without resampling anything.
+    starts = np.array([int((tick / TICKS_PER_SECOND) * sample_rate) for tick in game_events['tick'].tolist()], dtype=np.int64)
+    pairs, pair_of_event = np.unique(game_events['sound_index'].astype(np.int64) * 256 + game_events['note_index'], return_inverse=True)
+    pair_lengths = []
+    for sound_index, note_index in zip((pairs // 256).tolist(), (pairs % 256).tolist()):
+        sound_file = GAME_SOUND_PALETTE[sound_index]
+        pair_lengths.append(int(len(sound_data_cache[sound_file]) / game_pitch_rate(sound_file, note_index)) if sound_file in sound_data_cache else 0)
+    return starts, np.array(pair_lengths, dtype=np.int64)[pair_of_event.ravel()]
+
+def _mix_segment(game_events, pitch_bank, sample_rate, segment_start, segment_end):
+    # Same per-sample additions, in the same order, as _mix_full restricted to [segment_start, segment_end).
+    mix = np.zeros(segment_end - segment_start, dtype=np.float32)
+    for start_sample, resampled_data, volume in _iter_event_buffers(game_events, pitch_bank, sample_rate):
+        lo, hi = max(start_sample, segment_start), min(start_sample + len(resampled_data), segment_end)
+        if hi > lo: mix[lo - segment_start : hi - segment_start] += resampled_data[lo - start_sample : hi - start_sample] * volume
+    return mix
+
+_segment_pitch_bank = None
+
+def _init_segment_worker(sound_folder, sound_files):
+    global _segment_pitch_bank
+    sound_bank = SoundBank.shared(sound_folder)
+    sound_bank.load(sound_files)
+    _segment_pitch_bank = sound_bank.pitch_bank
+
+def _render_segment(game_events, sample_rate, segment_start, segment_end):
+    return segment_start, _mix_segment(game_events, _segment_pitch_bank, sample_rate, segment_start, segment_end)
+
+def _mix_parallel(game_events, sound_folder, sound_data_cache, sample_rate, total_samples, render_workers, min_segment_sec=5.0):
+    """
+    Splits the timeline into segments and mixes them in a process pool. Each segment gets every
+    event whose pitched buffer overlaps it, tails included, so stitching the segments gives the
+    same samples as _mix_full. Forked workers start with a copy of this process's sound bank.
+    """
+    num_segments = max(1, min(render_workers * 4, int(total_samples / (min_segment_sec * sample_rate))))
+    bounds = np.linspace(0, total_samples, num_segments + 1).astype(np.int64)
+    starts, lengths = _event_spans(game_events, sound_data_cache, sample_rate)
+    first_segment = np.searchsorted(bounds, starts, side='right') - 1
+    last_segment = np.searchsorted(bounds, starts + np.maximum(lengths, 1) - 1, side='right') - 1
+
+    master_track = np.zeros(total_samples, dtype=np.float32)
+    with ProcessPoolExecutor(max_workers=render_workers, initializer=_init_segment_worker, initargs=(sound_folder, list(sound_data_cache))) as executor:
+        futures = [executor.submit(_render_segment, game_events[(first_segment <= i) & (last_segment >= i)], sample_rate, int(bounds[i]), int(bounds[i + 1]))
+                   for i in range(num_segments)]
+        for future in futures:
+            segment_start, mix = future.result()
+            master_track[segment_start : segment_start + len(mix)] = mix
+    return master_track
+
+def _iter_mixed_windows(game_events, pitch_bank, sample_rate, total_samples, window_samples):
+    """
+    Mixes the song in fixed-size windows. Sounds that ring past the end of a window are
+    carried into the next one, so memory depends on the window and the longest sound only.
+    """
+    events = _iter_event_buffers(game_events, pitch_bank, sample_rate)
+    pending = next(events, None)
+    carry = np.zeros(0, dtype=np.float32)
+    for window_start in range(0, total_samples, window_samples):
+        window_end = min(window_start + window_samples, total_samples)
+        mix = np.zeros(max(window_end - window_start, len(carry)), dtype=np.float32)
+        mix[:len(carry)] += carry
+        while pending is not None and pending[0] < window_end:
+            start_sample, resampled_data, volume = pending
+            len_to_mix = min(len(resampled_data), total_samples - start_sample)
+            offset = start_sample - window_start
+            if offset + len_to_mix > len(mix):
+                grown = np.zeros(offset + len_to_mix, dtype=np.float32)
+                grown[:len(mix)] = mix
+                mix = grown
+            mix[offset : offset + len_to_mix] += resampled_data[:len_to_mix] * volume
+            pending = next(events, None)
+        yield mix[:window_end - window_start]
+        carry = mix[window_end - window_start:].copy()
+
+def _write_wav_streaming(output_filename, sample_rate, windows, max_amp):
+    with wave.open(output_filename, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        for window in windows:
+            if max_amp > 0.0: window = window / max_amp
+            wav_file.writeframes((window * 32767).astype(np.int16).tobytes())
+
+def render_simulation_from_events(game_events, sound_folder, output_filename, sample_rate=PREVIEW_SAMPLE_RATE, streaming=False, window_sec=10.0, render_workers=1, mix_engine="auto", quality="full", max_seconds=None):
+    """
+    Mixes the game events into a mono WAV at output_filename (a path or a writable file object).
+    quality="draft" renders at DRAFT_SAMPLE_RATE with linear pitching on one process, and only
+    the first DRAFT_MAX_SECONDS unless max_seconds says otherwise. max_seconds also cuts full renders.
+    """
+    if mix_engine not in MIX_ENGINES: raise ValueError(f"Unknown mix engine '{mix_engine}'. Choose from: {', '.join(MIX_ENGINES)}.")
+    if quality not in PREVIEW_QUALITIES: raise ValueError(f"Unknown preview quality '{quality}'. Choose from: {', '.join(PREVIEW_QUALITIES)}.")
+    if quality == "draft":
+        sample_rate, render_workers = DRAFT_SAMPLE_RATE, 1
+        if max_seconds is None: max_seconds = DRAFT_MAX_SECONDS
+    if max_seconds: game_events = game_events[game_events['tick'] < max_seconds * TICKS_PER_SECOND]
+    if len(game_events) == 0: return
+    output_label = output_filename if isinstance(output_filename, str) else "memory"
+    print(f"\n--- Rendering {'draft ' if quality == 'draft' else ''}game simulation preview to '{output_label}' ---")
+    unique_sound_files = {GAME_SOUND_PALETTE[i] for i in np.unique(game_events['sound_index']).tolist()}
+    sound_bank = SoundBank.shared(sound_folder)
+    sound_data_cache = sound_bank.load(unique_sound_files)
+
+    if not sound_data_cache:
+        print("    -> ERROR: No sound files were loaded. Cannot render preview. Please check the --sound-folder path.")
+        return
+
+    total_ticks = int(game_events['tick'][-1])
+    total_duration_sec = (total_ticks / TICKS_PER_SECOND) + 3.0
+    if max_seconds: total_duration_sec = min(total_duration_sec, max_seconds)
+    total_samples = int(total_duration_sec * sample_rate)
+    print(f"Total song ticks: {total_ticks}. Rendering {total_duration_sec:.2f} seconds of audio...")
+
+    pitch_bank = sound_bank.draft_pitch_bank(sample_rate) if quality == "draft" else sound_bank.pitch_bank
+    built_before, reused_before = pitch_bank.misses, pitch_bank.hits
+    if streaming:
+        window_samples = max(1, int(window_sec * sample_rate))
+        print(f"Streaming in {window_sec:.1f}s windows. Measuring peak amplitude...")
+        max_amp = np.float32(0.0)
+        for window in _iter_mixed_windows(game_events, pitch_bank, sample_rate, total_samples, window_samples):
+            if len(window): max_amp = max(max_amp, np.max(np.abs(window)))
+    elif render_workers > 1:
+        print(f"Mixing timeline segments on {render_workers} worker processes...")
+        master_track = _mix_parallel(game_events, sound_folder, sound_data_cache, sample_rate, total_samples, render_workers)
+        max_amp = np.max(np.abs(master_track))
+    elif mix_engine != "events":
+        master_track = _mix_convolved(game_events, pitch_bank, sample_rate, total_samples, mix_engine)
+        max_amp = np.max(np.abs(master_track))
+    else:
+        master_track = _mix_full(game_events, pitch_bank, sample_rate, total_samples)
+        max_amp = np.max(np.abs(master_track))
+    if streaming or render_workers <= 1: print(f"Pitch bank: {pitch_bank.misses - built_before} pitched buffers built, {pitch_bank.hits - reused_before} reused.")
+
+    print("Performing final peak normalization and exporting...")
+    if max_amp > 1.0:
+        print(f"    WARNING: Clipping detected (max amplitude: {max_amp:.2f}). Normalizing audio.")
+
+    if max_amp <= 0.0:
+        print("    WARNING: Rendered audio is completely silent. This may happen if the MIDI is empty or sound files were not found.")
+
+    if streaming:
+        windows = _iter_mixed_windows(game_events, pitch_bank, sample_rate, total_samples, window_samples)
+        _write_wav_streaming(output_filename, sample_rate, windows, max_amp)
+    else:
+        if max_amp > 0.0: master_track /= max_amp
+        wavfile.write(output_filename, sample_rate, (master_track * 32767).astype(np.int16))
+    print(f"Successfully rendered simulation to '{output_label}'!")
@@ -0,0 +1,188 @@
+import numpy as np
+from constants import NOTE_INDEX_TO_CHAR_MAP, SOUND_NAMES, TICKS_PER_SECOND
+
+# Mirrors S.init() and MusicPlayer in world_code.js.
+MAX_TASKS_PER_TICK = 50
+CHUNK_SIZE_IN_NOTES = 100
+CHAR_TO_INDEX = {c: i for i, c in enumerate(NOTE_INDEX_TO_CHAR_MAP)}
+
+
+class SchedulerBudgetError(Exception):
+    pass
+
+
+class TickScheduler:
+    """
+    Model of the in-game S scheduler. tick() runs the first MAX_TASKS_PER_TICK tasks queued
+    for the current tick and then deletes the tick, so the rest are lost, and so is anything
+    scheduled into a tick while that tick is running.
+    """
+    def __init__(self, max_tasks_per_tick=MAX_TASKS_PER_TICK):
+        self.max_tasks_per_tick = max_tasks_per_tick
+        self.current_tick = 0
+        self.tasks = {}
+        self.tasks_per_tick = {}
+        self.dropped = []
+
+    def set_timeout(self, task, delay=1):
+        self.tasks.setdefault(self.current_tick + delay, []).append(task)
+
+    def tick(self):
+        tasks = self.tasks.get(self.current_tick)
+        if tasks:
+            queued = len(tasks)
+            self.tasks_per_tick[self.current_tick] = queued
+            for task in tasks[:min(queued, self.max_tasks_per_tick)]: task()
+            self.dropped.extend((self.current_tick, task, "over_budget") for task in tasks[self.max_tasks_per_tick:queued])
+            self.dropped.extend((self.current_tick, task, "same_tick") for task in tasks[queued:])
+            del self.tasks[self.current_tick]
+        self.current_tick += 1
+
+    def run(self):
+        while self.tasks: self.tick()
+
+
+class _Broadcast:
+    # A scheduled api.broadcastSound call; kept as an object so dropped ones can be reported.
+    def __init__(self, scheduler, played, sound_index, note_index, volume_index):
+        self.scheduler, self.played = scheduler, played
+        self.sound_index, self.note_index, self.volume_index = sound_index, note_index, volume_index
+
+    def __call__(self):
+        self.played.append((self.scheduler.current_tick, self.sound_index, self.note_index, self.volume_index))
+
+
+class _ChunkTask:
+    def __init__(self, schedule_chunk, start_index):
+        self.schedule_chunk, self.start_index = schedule_chunk, start_index
+
+    def __call__(self):
+        self.schedule_chunk(self.start_index)
+
+
+def _play_v1(scheduler, payload, played, chunk_costs):
+    sounds, delays, notes, volumes = payload["sounds"], payload["delays"], payload["notes"], payload["volumes"]
+
+    def schedule_chunk(start_index):
+        relative_ticks = 0
+        end_index = min(start_index + CHUNK_SIZE_IN_NOTES, len(sounds))
+        for i in range(start_index, end_index):
+            relative_ticks += CHAR_TO_INDEX[delays[i]]
+            scheduler.set_timeout(_Broadcast(scheduler, played, int(sounds[i]), CHAR_TO_INDEX[notes[i]], int(volumes[i])), relative_ticks)
+        chunk_costs.append((scheduler.current_tick, end_index - start_index))
+        if end_index < len(sounds):
+            scheduler.set_timeout(_ChunkTask(schedule_chunk, end_index), relative_ticks)
+
+    schedule_chunk(0)
+
+def _play_v2(scheduler, payload, played, chunk_costs):
+    from payload import PAYLOAD_V2_HEADER, EVENT_SYMBOL_BASE, DELAY_SYMBOL_BASE, NUM_NOTE_SYMBOLS, NUM_VOLUME_LEVELS
+    song = payload["song"]
+
+    def schedule_chunk(start_index):
+        relative_ticks, notes_in_chunk, i = 0, 0, start_index
+        while i < len(song) and (notes_in_chunk < CHUNK_SIZE_IN_NOTES or ord(song[i]) >= EVENT_SYMBOL_BASE):
+            code = ord(song[i]); i += 1
+            if code < EVENT_SYMBOL_BASE:
+                relative_ticks += code - DELAY_SYMBOL_BASE + 1
+                continue
+            voice, note_index = divmod(code - EVENT_SYMBOL_BASE, NUM_NOTE_SYMBOLS)
+            sound_index, volume_index = divmod(voice, NUM_VOLUME_LEVELS)
+            scheduler.set_timeout(_Broadcast(scheduler, played, sound_index, note_index, volume_index), relative_ticks)
+            notes_in_chunk += 1
+        chunk_costs.append((scheduler.current_tick, notes_in_chunk))
+        if i < len(song):
+            scheduler.set_timeout(_ChunkTask(schedule_chunk, i), relative_ticks)
+
+    schedule_chunk(len(PAYLOAD_V2_HEADER))
+
+def _play_v3(scheduler, payload, played, chunk_costs):
+    from payload import PAYLOAD_V3_HEADER, VOICE_TABLE_END, EVENT_SYMBOL_BASE, DELAY_SYMBOL_BASE, NUM_NOTE_SYMBOLS, NUM_VOLUME_LEVELS
+    song = payload["song"]
+    table_end = song.index(VOICE_TABLE_END)
+    voices = [(divmod(packed // NUM_NOTE_SYMBOLS, NUM_VOLUME_LEVELS), packed % NUM_NOTE_SYMBOLS)
+              for packed in (ord(c) - EVENT_SYMBOL_BASE for c in song[len(PAYLOAD_V3_HEADER):table_end])]
+    cursor = table_end + 1
+
+    def schedule_next_tick_group():
+        nonlocal cursor
+        delay = 0
+        while cursor < len(song) and ord(song[cursor]) < EVENT_SYMBOL_BASE:
+            delay += ord(song[cursor]) - DELAY_SYMBOL_BASE + 1
+            cursor += 1
+        if cursor < len(song): scheduler.set_timeout(_ChunkTask(play_tick_group, None), delay)
+
+    def play_tick_group(_):
+        nonlocal cursor
+        group_start = cursor
+        while cursor < len(song) and ord(song[cursor]) >= EVENT_SYMBOL_BASE:
+            (sound_index, volume_index), note_index = voices[ord(song[cursor]) - EVENT_SYMBOL_BASE]
+            _Broadcast(scheduler, played, sound_index, note_index, volume_index)()
+            cursor += 1
+        chunk_costs.append((scheduler.current_tick, cursor - group_start))
+        schedule_next_tick_group()
+
+    schedule_next_tick_group()
+
+PLAYERS = {"v1": _play_v1, "v2": _play_v2, "v3": _play_v3}
+
+def simulate_payload(payload, payload_format="v1", max_tasks_per_tick=MAX_TASKS_PER_TICK):
+    """
+    Plays an encoded song (the "payload" dict from convert_midi) through the scheduler model,
+    starting from tick 0, and returns a load report. Lost broadcasts are split into
+    "over_budget" (past the per-tick limit) and "same_tick" (scheduled into the running tick).
+    """
+    scheduler = TickScheduler(max_tasks_per_tick)
+    played, chunk_costs = [], []
+    PLAYERS[payload_format](scheduler, payload, played, chunk_costs)
+    scheduler.run()
+
+    dropped_broadcasts, dropped_chunks = [], 0
+    for tick, task, reason in scheduler.dropped:
+        if isinstance(task, _ChunkTask): dropped_chunks += 1
+        else: dropped_broadcasts.append({"tick": tick, "sound": SOUND_NAMES[task.sound_index], "note_index": task.note_index, "reason": reason})
+
+    ticks = np.fromiter(scheduler.tasks_per_tick.keys(), dtype=np.int64, count=len(scheduler.tasks_per_tick))
+    loads = np.fromiter(scheduler.tasks_per_tick.values(), dtype=np.int64, count=len(ticks))
+    chunk_sizes = np.array([n for _, n in chunk_costs], dtype=np.int64)
+    broadcasts_per_tick = np.unique(np.array([tick for tick, *_ in played], dtype=np.int64), return_counts=True)[1]
+    peak = int(np.argmax(loads)) if len(loads) else None
+    return {
+        "payload_format": payload_format,
+        "max_tasks_per_tick": max_tasks_per_tick,
+        "broadcasts_played": len(played),
+        "broadcasts_dropped": len(dropped_broadcasts),
+        "dropped_over_budget": sum(d["reason"] == "over_budget" for d in dropped_broadcasts),
+        "dropped_same_tick": sum(d["reason"] == "same_tick" for d in dropped_broadcasts),
+        "dropped_chunk_tasks": dropped_chunks,
+        "dropped": dropped_broadcasts,
+        "busy_ticks": len(loads),
+        "peak_tasks_per_tick": int(loads[peak]) if peak is not None else 0,
+        "peak_tick": int(ticks[peak]) if peak is not None else None,
+        "ticks_over_budget": int((loads > max_tasks_per_tick).sum()),
+        "mean_tasks_per_busy_tick": float(loads.mean()) if len(loads) else 0.0,
+        "peak_broadcasts_per_tick": int(broadcasts_per_tick.max()) if len(broadcasts_per_tick) else 0,
+        "chunk_calls": len(chunk_costs),
+        "max_notes_scheduled_per_call": int(chunk_sizes.max()) if len(chunk_sizes) else 0,
+        "tasks_per_tick": dict(zip(ticks.tolist(), loads.tolist())),
+    }
+
+def exceeds_budget(report):
+    return report["broadcasts_dropped"] > 0 or report["dropped_chunk_tasks"] > 0
+
+def format_scheduler_report(report):
+    lines = [f"--- Scheduler simulation ({report['payload_format']}, {report['max_tasks_per_tick']} tasks/tick) ---",
+             f"Played {report['broadcasts_played']} broadcasts over {report['busy_ticks']} busy ticks. "
+             f"Peak load {report['peak_tasks_per_tick']} tasks at tick {report['peak_tick']}, mean {report['mean_tasks_per_busy_tick']:.1f}. "
+             f"Up to {report['peak_broadcasts_per_tick']} broadcasts in one tick.",
+             f"Chunk scheduling: {report['chunk_calls']} calls, up to {report['max_notes_scheduled_per_call']} notes scheduled in one call."]
+    if report["ticks_over_budget"]:
+        lines.append(f"    WARNING: {report['ticks_over_budget']} ticks exceed the budget; {report['dropped_over_budget']} broadcasts are dropped.")
+    if report["dropped_same_tick"]:
+        lines.append(f"    WARNING: {report['dropped_same_tick']} broadcasts land in the tick that schedules them and are dropped (chunk boundaries).")
+    if report["dropped_chunk_tasks"]:
+        lines.append(f"    WARNING: {report['dropped_chunk_tasks']} chunk tasks are dropped; the song stops early.")
+    for d in report["dropped"][:10]:
+        lines.append(f"    - Tick {d['tick']:04d} ({d['tick'] / TICKS_PER_SECOND:.2f}s): {d['sound']} note {d['note_index']} ({d['reason']})")
+    if len(report["dropped"]) > 10: lines.append(f"    ... and {len(report['dropped']) - 10} more.")
+    return "\n".join(lines)
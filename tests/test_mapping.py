@@ -0,0 +1,42 @@
+import itertools
+import numpy as np
+import pytest
+from processor import (map_notes_to_events, find_piano_sounds_for_note, hz_to_closest_piano_note_index, midi_to_hz,
+                       NOTE_DTYPE, PIANO_SOUND_DATA, SOUND_TO_INDEX, PRIMARY_SOUND_NAME, VOLUME_LEVELS)
+
+PALETTES = [list(palette) for size in range(1, len(PIANO_SOUND_DATA) + 1) for palette in itertools.combinations(PIANO_SOUND_DATA, size)]
+
+
+@pytest.fixture(scope="module")
+def parsed_notes():
+    rng = np.random.default_rng(0)
+    parsed_notes = np.zeros(600, dtype=NOTE_DTYPE)
+    parsed_notes['start_tick'] = np.sort(rng.integers(0, 2000, len(parsed_notes)))
+    parsed_notes['duration_sec'] = rng.uniform(0.01, 3.0, len(parsed_notes))
+    parsed_notes['midi_note'] = rng.integers(21, 109, len(parsed_notes))
+    parsed_notes['velocity'] = rng.integers(1, 128, len(parsed_notes))
+    return parsed_notes
+
+def per_note_events(parsed_notes, palette, layering_config):
+    # The events the per-note mapping gives: (tick, sound, note, volume index, pitch rate), harp_pling first, then layers.
+    events = []
+    for note in parsed_notes:
+        pitch_hz = midi_to_hz(int(note['midi_note']))
+        sounds = find_piano_sounds_for_note({"pitch_hz": pitch_hz, "duration_sec": float(note['duration_sec'])}, palette, layering_config)
+        num_layers = sum(sound['filename'] != PRIMARY_SOUND_NAME for sound in sounds)
+        for sound in sounds:
+            volume_index = 0 if sound['filename'] == PRIMARY_SOUND_NAME else num_layers
+            events.append((int(note['start_tick']), SOUND_TO_INDEX[sound['filename']], int(hz_to_closest_piano_note_index(pitch_hz)), volume_index, sound['rate']))
+    return events
+
+
+@pytest.mark.parametrize("max_layers", range(0, 6))
+@pytest.mark.parametrize("palette", PALETTES, ids=lambda palette: "+".join(s['filename'].split('.')[0] for s in palette))
+def test_batched_mapping_matches_per_note_mapping(parsed_notes, palette, max_layers):
+    layering_config = {"max_layers": max_layers}
+    game_events = map_notes_to_events(parsed_notes, palette, layering_config)
+    expected = per_note_events(parsed_notes, palette, layering_config)
+    assert len(game_events) == len(expected)
+    assert [tuple(event[:4]) for event in expected] == list(zip(*(game_events[field].tolist() for field in ('tick', 'sound_index', 'note_index', 'volume_index'))))
+    assert np.allclose(game_events['pitch_rate'], [event[4] for event in expected])
+    assert np.array_equal(game_events['volume'], VOLUME_LEVELS[game_events['volume_index']].astype(np.float32))
@@ -0,0 +1,82 @@
+import contextlib
+import glob
+import io
+import os
+import numpy as np
+import pytest
+from processor import convert_midi, encode_payload, chunk_payload, sort_and_compute_delays, EVENT_DTYPE, VOLUME_LEVELS, GAME_SOUND_PALETTE
+from payload import (encode_v2, decode_v2, encode_v3, decode_v3, build_keyframe_index, parse_keyframe_index, seek, song_stream_start, split_song, split_keyframes,
+                     EVENT_SYMBOL_BASE, MAX_DELAY_SYMBOL_TICKS)
+
+MIDI_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "midis")
+FORMATS = [("v2", encode_v2, decode_v2), ("v3", encode_v3, decode_v3)]
+
+
+def synthetic_events(num_events=3000, seed=0):
+    # Chords, repeated voices and one rest longer than a single delay symbol can hold.
+    rng = np.random.default_rng(seed)
+    game_events = np.zeros(num_events, dtype=EVENT_DTYPE)
+    steps = rng.choice([0, 0, 1, 2, 7, 40], num_events)
+    steps[num_events // 2] = 3 * MAX_DELAY_SYMBOL_TICKS + 5
+    game_events['tick'] = np.cumsum(steps)
+    game_events['sound_index'] = rng.integers(0, len(GAME_SOUND_PALETTE), num_events)
+    game_events['note_index'] = rng.integers(0, 88, num_events)
+    game_events['volume_index'] = rng.integers(0, len(VOLUME_LEVELS), num_events)
+    game_events['volume'] = VOLUME_LEVELS[game_events['volume_index']]
+    return sort_and_compute_delays(game_events)
+
+def midi_events(midi_path):
+    with contextlib.redirect_stdout(io.StringIO()): return convert_midi(midi_path, {}, output_profile="lean")["events"]
+
+SONGS = {"synthetic": synthetic_events, **{os.path.basename(path): (lambda path=path: midi_events(path)) for path in sorted(glob.glob(os.path.join(MIDI_DIR, "*.mid")))}}
+
+@pytest.fixture(scope="module", params=list(SONGS))
+def game_events(request):
+    return SONGS[request.param]()
+
+
+@pytest.mark.parametrize("payload_format, encode, decode", FORMATS, ids=[f[0] for f in FORMATS])
+def test_song_decodes_back_to_its_events(game_events, payload_format, encode, decode):
+    decoded = decode(encode(game_events))
+    for field in ('tick', 'sound_index', 'volume_index', 'note_index'):
+        assert np.array_equal(decoded[field], game_events[field]), field
+
+@pytest.mark.parametrize("payload_format, encode, decode", FORMATS, ids=[f[0] for f in FORMATS])
+def test_seek_resumes_at_start_tick(game_events, payload_format, encode, decode):
+    # Playing from where seek lands gives exactly the events at or after start_tick, at their original ticks.
+    song = encode(game_events)
+    keyframes = build_keyframe_index(song, 20)
+    last_tick = int(game_events['tick'][-1])
+    for start_tick in sorted(set(range(0, 200)) | set(range(0, last_tick + 2, max(7, last_tick // 400)))):
+        offset, wait_ticks = seek(song, keyframes, start_tick)
+        resumed = decode(song[:song_stream_start(song)] + song[offset:])
+        expected = game_events[game_events['tick'] >= start_tick]
+        assert len(resumed) == len(expected), start_tick
+        assert np.array_equal(resumed['tick'] + start_tick + wait_ticks, expected['tick']), start_tick
+        assert np.array_equal(resumed['note_index'], expected['note_index']), start_tick
+
+@pytest.mark.parametrize("max_chars", [50, 1000, 16000])
+@pytest.mark.parametrize("payload_format, encode, decode", FORMATS, ids=[f[0] for f in FORMATS])
+def test_split_song_cuts_between_tick_groups(game_events, payload_format, encode, decode, max_chars):
+    song = encode(game_events)
+    parts = split_song(song, max_chars)
+    assert "".join(parts) == song
+    for before, after in zip(parts, parts[1:]):
+        assert ord(before[-1]) >= EVENT_SYMBOL_BASE and ord(after[0]) < EVENT_SYMBOL_BASE
+
+@pytest.mark.parametrize("max_chars", [20, 300])
+def test_split_keyframes_cuts_between_entries(game_events, max_chars):
+    keyframes = build_keyframe_index(encode_v2(game_events), 20)
+    parts = split_keyframes(keyframes, max_chars)
+    assert "".join(parts) == keyframes
+    assert all(len(part) <= max_chars for part in parts)
+    assert all(part.endswith(",") for part in parts[:-1])
+    assert parse_keyframe_index("".join(parts)) == parse_keyframe_index(keyframes)
+
+def test_v1_parts_line_up(game_events):
+    payload = encode_payload(game_events, "v1")
+    parts = chunk_payload(payload, "v1", 1000)
+    assert len({len(block_parts) for block_parts in parts.values()}) == 1
+    for block, text in payload.items():
+        assert "".join(parts[block]) == text
+        assert all(len(part) <= 1000 for part in parts[block])
@@ -50,15 +50,37 @@ class MusicPlayer {
         this.SEMITONE_RATIO = 2 ** (1 / 12);
         this.volumeLevels = [1.0, 0.8 / 1, 0.8 / 2, 0.8 / 3, 0.8 / 4];
         this.CHUNK_SIZE_IN_NOTES = 100;
+
+        // v2 compact payload: one symbol per note, delay symbols only between ticks (see payload.py).
+        this.COMPACT_HEADER = "v2";
+        this.EVENT_SYMBOL_BASE = 0x4E00;
+        this.DELAY_SYMBOL_BASE = 0x3400;
+
+        // v3 tick-indexed payload: a voice table, then the v2 stream with voice numbers as event symbols.
+        this.TICK_INDEXED_HEADER = "v3";
+        this.VOICE_TABLE_END = ":";
+        this.voices = [];
+        this.song = "";
+        this.cursor = 0;
+        this._tickGroupTask = () => this._playTickGroup();
+        this.keyframeCache = { text: null, interval: 0, offsets: [], ticks: [] };
+
+        // Long songs are exported as several code blocks; the player walks them in order instead of joining them.
+        this.songParts = [];
+        this.partIndex = 0;
     }
 
+    // Each argument is one code block's text, or an array of them for a song split into parts (same events in every stream).
     playSong(sounds, delays, notes, volumes) {
         if (!sounds || !delays || !notes || !volumes) {
             api.log("MusicPlayer Error: Missing song data.");
             return;
         }
+        this.songParts = Array.isArray(sounds) ? sounds.map((_, p) => [sounds[p], delays[p], notes[p], volumes[p]]) : [[sounds, delays, notes, volumes]];
+        this.partIndex = 0;
         S.reset();
-        this._scheduleChunk(sounds, delays, notes, volumes, 0);
+        const part = this.songParts[0];
+        this._scheduleChunk(part[0], part[1], part[2], part[3], 0);
     }
 
     _scheduleChunk(sounds, delays, notes, volumes, startIndex) {
@@ -91,7 +113,183 @@ class MusicPlayer {
         if (endIndex < sounds.length) {
             const scheduleNextChunkTask = () => this._scheduleChunk(sounds, delays, notes, volumes, endIndex);
             S.setTimeout(scheduleNextChunkTask, relativeTicksInChunk);
+        } else if (this.partIndex + 1 < this.songParts.length) {
+            // Parts hold a whole number of chunks, so the next part starts exactly where the next chunk would.
+            const next = this.songParts[++this.partIndex];
+            const scheduleNextPartTask = () => this._scheduleChunk(next[0], next[1], next[2], next[3], 0);
+            S.setTimeout(scheduleNextPartTask, relativeTicksInChunk);
+        }
+    }
+
+    // song is one code block's text, or an array of them for a song split into parts between tick groups.
+    playCompactSong(song) {
+        const parts = Array.isArray(song) ? song : [song];
+        if (parts[0] && parts[0].startsWith(this.TICK_INDEXED_HEADER)) return this._playTickIndexedSong(parts);
+        if (!parts[0] || !parts[0].startsWith(this.COMPACT_HEADER)) {
+            api.log("MusicPlayer Error: Not a v2 or v3 song payload.");
+            return;
+        }
+        this.songParts = parts;
+        this.partIndex = 0;
+        S.reset();
+        this._scheduleCompactChunk(parts[0], this.COMPACT_HEADER.length);
+    }
+
+    _scheduleCompactChunk(song, startIndex, initialDelay = 0) {
+        let relativeTicksInChunk = initialDelay;
+        let notesInChunk = 0;
+        let i = startIndex;
+
+        // A chunk only ends on a delay symbol, so the next chunk never schedules into the tick that is running it.
+        while (true) {
+            if (i >= song.length) {
+                if (this.partIndex + 1 >= this.songParts.length) break;
+                song = this.songParts[++this.partIndex];
+                i = 0;
+            }
+            if (notesInChunk >= this.CHUNK_SIZE_IN_NOTES && song.charCodeAt(i) < this.EVENT_SYMBOL_BASE) break;
+            const code = song.charCodeAt(i++);
+            if (code < this.EVENT_SYMBOL_BASE) {
+                relativeTicksInChunk += code - this.DELAY_SYMBOL_BASE + 1;
+                continue;
+            }
+            const packed = code - this.EVENT_SYMBOL_BASE;
+            const noteIndex = packed % 88;
+            const voice = (packed - noteIndex) / 88;
+            const volumeIndex = voice % 5;
+            const soundInfo = this.soundData[(voice - volumeIndex) / 5];
+            const volume = this.volumeLevels[volumeIndex];
+            const rate = 440.0 * (2 ** ((noteIndex - 48) / 12)) / soundInfo.hz;
+            const playNoteTask = () => api.broadcastSound(soundInfo.name, volume, rate);
+            S.setTimeout(playNoteTask, relativeTicksInChunk);
+            notesInChunk++;
+        }
+
+        if (i < song.length) {
+            const scheduleNextChunkTask = () => this._scheduleCompactChunk(song, i);
+            S.setTimeout(scheduleNextChunkTask, relativeTicksInChunk);
+        }
+    }
+
+    // Starts a v2/v3 song (text or array of parts) at startTick (seconds * 20) using its keyframe index ("interval|offset:tick,...").
+    playSongFrom(song, keyframes, startTick) {
+        if (!keyframes) {
+            api.log("MusicPlayer Error: Missing keyframe index.");
+            return;
+        }
+        const parts = Array.isArray(song) ? song : [song];
+        const index = this._parseKeyframes(keyframes);
+        if (!index.offsets.length) return;
+        const k = Math.min(Math.floor(Math.max(startTick, 0) / index.interval), index.offsets.length - 1);
+        // Keyframe offsets count characters across all parts.
+        let p = 0;
+        let i = index.offsets[k];
+        while (p + 1 < parts.length && i >= parts[p].length) i -= parts[p++].length;
+        let part = parts[p];
+        let tick = index.ticks[k];
+        while (tick < startTick && i < part.length) {
+            let code = part.charCodeAt(i);
+            while (code >= this.EVENT_SYMBOL_BASE) code = part.charCodeAt(++i);
+            if (i >= part.length && p + 1 < parts.length) {
+                part = parts[++p];
+                i = 0;
+                code = part.charCodeAt(0);
+            }
+            while (code < this.EVENT_SYMBOL_BASE) {
+                tick += code - this.DELAY_SYMBOL_BASE + 1;
+                code = part.charCodeAt(++i);
+            }
+        }
+        if (i >= part.length) return;
+
+        if (parts[0].startsWith(this.TICK_INDEXED_HEADER)) return this._playTickIndexedSong(parts, p, i, tick - startTick);
+        if (!parts[0].startsWith(this.COMPACT_HEADER)) {
+            api.log("MusicPlayer Error: Not a v2 or v3 song payload.");
+            return;
+        }
+        this.songParts = parts;
+        this.partIndex = p;
+        S.reset();
+        this._scheduleCompactChunk(part, i, tick - startTick);
+    }
+
+    // Parsed once per keyframe text, so replaying or looping a section only costs the lookup.
+    _parseKeyframes(keyframes) {
+        // A long index comes as an array of code block texts, cut between entries.
+        if (Array.isArray(keyframes)) keyframes = keyframes.join("");
+        if (this.keyframeCache.text === keyframes) return this.keyframeCache;
+        const separator = keyframes.indexOf("|");
+        const index = { text: keyframes, interval: +keyframes.slice(0, separator), offsets: [], ticks: [] };
+        const entries = keyframes.slice(separator + 1);
+        if (entries) for (const entry of entries.split(",")) {
+            const colon = entry.indexOf(":");
+            index.offsets[index.offsets.length] = +entry.slice(0, colon);
+            index.ticks[index.ticks.length] = +entry.slice(colon + 1);
+        }
+        this.keyframeCache = index;
+        return index;
+    }
+
+    _playTickIndexedSong(parts, startPart = 0, startIndex = -1, initialDelay = 0) {
+        const song = parts[0];
+        const tableEnd = song.indexOf(this.VOICE_TABLE_END);
+        if (tableEnd < 0) {
+            api.log("MusicPlayer Error: v3 song payload has no voice table.");
+            return;
+        }
+        this.voices = [];
+        for (let i = this.TICK_INDEXED_HEADER.length; i < tableEnd; i++) {
+            const packed = song.charCodeAt(i) - this.EVENT_SYMBOL_BASE;
+            const noteIndex = packed % 88;
+            const voice = (packed - noteIndex) / 88;
+            const volumeIndex = voice % 5;
+            const soundInfo = this.soundData[(voice - volumeIndex) / 5];
+            this.voices[this.voices.length] = { name: soundInfo.name, volume: this.volumeLevels[volumeIndex], rate: 440.0 * (2 ** ((noteIndex - 48) / 12)) / soundInfo.hz };
+        }
+        S.reset();
+        this.songParts = parts;
+        this.partIndex = startPart;
+        this.song = parts[startPart];
+        if (startIndex < 0) {
+            this.cursor = tableEnd + 1;
+            this._scheduleNextTickGroup();
+        } else {
+            this.cursor = startIndex;
+            S.setTimeout(this._tickGroupTask, initialDelay);
+        }
+    }
+
+    // Sums the delay symbols at the cursor and schedules the one task that plays the next tick group.
+    _scheduleNextTickGroup() {
+        let song = this.song;
+        let i = this.cursor;
+        let delay = 0;
+        let code = song.charCodeAt(i);
+        // Parts end after a tick group, so at the end of one the rest before the next group starts the next part.
+        if (i >= song.length && this.partIndex + 1 < this.songParts.length) {
+            song = this.song = this.songParts[++this.partIndex];
+            i = 0;
+            code = song.charCodeAt(0);
+        }
+        while (code < this.EVENT_SYMBOL_BASE) {
+            delay += code - this.DELAY_SYMBOL_BASE + 1;
+            code = song.charCodeAt(++i);
+        }
+        this.cursor = i;
+        if (i < song.length) S.setTimeout(this._tickGroupTask, delay);
+    }
+
+    _playTickGroup() {
+        const song = this.song;
+        let i = this.cursor;
+        let code = song.charCodeAt(i);
+        while (code >= this.EVENT_SYMBOL_BASE) {
+            const voice = this.voices[code - this.EVENT_SYMBOL_BASE];
+            api.broadcastSound(voice.name, voice.volume, voice.rate);
+            code = song.charCodeAt(++i);
         }
+        this.cursor = i;
+        this._scheduleNextTickGroup();
     }
 }
 